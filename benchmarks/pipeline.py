@@ -0,0 +1,249 @@
+"""
+Throughput of the preprocessing hot paths on synthetic cuts, generated with
+ffmpeg (a moving test pattern and a tone) at the resolution of each speaker.
+No download or GPU is needed: detection runs on the cpu with a stub detector
+that returns a fixed box, unless --s3fd is given.
+
+Each stage runs in a fresh process so that its peak RSS is measured alone.
+The results are written as JSON, to be compared between commits:
+
+    python benchmarks/pipeline.py --out before.json
+"""
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+import subprocess
+import multiprocessing as mp
+from pathlib import Path
+
+RESOLUTIONS = {
+    "chem": (1280, 720),
+    "chess": (1920, 1080),
+    "dl": (1280, 720),
+    "eh": (1280, 720),
+    "hs": (1280, 720),
+}
+
+STAGES = ["loader", "detect", "prepare_video", "prepare_audio", "spectrogram"]
+
+
+def make_cut(path, resolution, duration, fps):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    width, height = resolution
+    command = [
+        *("ffmpeg", "-loglevel", "panic", "-y"),
+        *("-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={fps}"),
+        *("-f", "lavfi", "-i", "sine=frequency=440:sample_rate=44100"),
+        *("-t", str(duration)),
+        *("-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p"),
+        *("-c:a", "aac", str(path)),
+    ]
+    subprocess.run(command, check=True)
+
+
+def copy_cut(source, root, speaker):
+    """A fresh dataset root holding a copy of the cut, so no stage sees outputs of another"""
+    mp4 = root / speaker / "intervals" / "bench" / "cut-0.mp4"
+    mp4.parent.mkdir(parents=True)
+    shutil.copy(source, mp4)
+    return mp4
+
+
+def prepare_args(args):
+    from lip2wav_dataset.prepare import add_spec_arguments
+
+    parser = argparse.ArgumentParser()
+    add_spec_arguments(parser)
+    hparams = parser.parse_args([])
+    hparams.sample_rate = args.sample_rate
+    hparams.frame_format = args.frame_format
+    return hparams
+
+
+class StubDetector:
+    """Stands in for s3fd, a box at the center of each image"""
+
+    def detect(self, images, scale_factor):
+        import pandas as pd
+
+        _, _, h, w = images.shape
+        y1, y2, x1, x2 = h // 4, h * 3 // 4, w // 4, w * 3 // 4
+        bbox = pd.DataFrame([dict(x1=x1, y1=y1, x2=x2, y2=y2, score=1.0)])
+        patches = [iter([image[:, y1:y2, x1:x2]]) for image in images]
+        return [bbox] * len(images), patches
+
+
+def bench_loader(mp4, speaker, args):
+    from lip2wav_dataset.detect import Cut, VideoFrameLoader
+
+    loader = VideoFrameLoader(
+        [Cut(mp4, speaker, 600, dict(detector="s3fd", scale_factor=0.5))],
+        args.batch_size,
+        "cpu",
+        frame_format=args.frame_format,
+    )
+    frames = 0
+    for images, _ in loader:
+        frames += len(images)
+    return dict(frames=frames)
+
+
+def bench_detect(mp4, speaker, args):
+    from lip2wav_dataset.detect import ImageWriter, detect
+    from lip2wav_dataset.manifest import Manifest
+
+    if args.s3fd:
+        from efd import s3fd
+
+        model = s3fd(pretrained=True).to("cpu")
+    else:
+        model = StubDetector()
+    detect_args = argparse.Namespace(
+        root=args.root,
+        batch_size=args.batch_size,
+        device="cpu",
+        concurrent_cuts=4,
+        frame_format=args.frame_format,
+        scale_factor=0.5,
+        lease_ttl=600,
+        checkpoint_interval=60,
+    )
+    writer = ImageWriter(4, 256)
+    manifest = Manifest(args.root)
+    try:
+        detect(model, [mp4], detect_args, writer, manifest)
+    finally:
+        writer.close()
+        manifest.close()
+    return dict(frames=writer.written)
+
+
+def bench_prepare_video(mp4, speaker, args):
+    import numpy as np
+    from lip2wav_dataset.prepare import CutDetection, prepare_video
+
+    width, height = RESOLUTIONS[speaker]
+    frame_ids = np.arange(round(args.duration * args.fps))
+    box = [height // 4, height * 3 // 4, width // 4, width * 3 // 4]
+    boxes = np.tile(box, (len(frame_ids), 1))
+    prepare_video(mp4, CutDetection(frame_ids, boxes, (width, height)), args.frame_format)
+    return dict(frames=len(frame_ids))
+
+
+def bench_prepare_audio(mp4, speaker, args):
+    from lip2wav_dataset.prepare import prepare_audio
+
+    prepare_audio(mp4, prepare_args(args))
+    return dict(audio_seconds=args.duration)
+
+
+def bench_spectrogram(mp4, speaker, args):
+    from lip2wav_dataset import audio
+    from lip2wav_dataset.media import decode_audio
+
+    hparams = prepare_args(args)
+    _, sample_rate, pcm = decode_audio(mp4, speaker, args.sample_rate)
+    wav = audio.pcm_to_wav(pcm, sample_rate, args.sample_rate)
+    audio.warmup_cache(hparams)
+    timings = {}
+    for name, function in [
+        ("melspectrogram", audio.melspectrogram),
+        ("linearspectrogram", audio.linearspectrogram),
+        ("spectrograms", lambda wav, hparams: audio.spectrograms([wav], hparams)),
+    ]:
+        start = time.perf_counter()
+        function(wav, hparams)
+        timings[name] = time.perf_counter() - start
+    seconds = len(wav) / args.sample_rate
+    return {
+        f"{name}_audio_seconds_per_second": seconds / elapsed
+        for name, elapsed in timings.items()
+    }
+
+
+def run_stage(stage, mp4, speaker, args):
+    """Runs in a child process, returns the throughput and peak RSS of the stage"""
+    function = globals()[f"bench_{stage}"]
+    start = time.perf_counter()
+    result = function(mp4, speaker, args)
+    elapsed = time.perf_counter() - start
+    if "frames" in result:
+        result["frames_per_second"] = result["frames"] / elapsed
+    if "audio_seconds" in result:
+        result["audio_seconds_per_second"] = result["audio_seconds"] / elapsed
+    result["seconds"] = elapsed
+    # kilobytes on linux, ffmpeg children are included
+    result["peak_rss_mb"] = (
+        max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        )
+        / 1024
+    )
+    return result
+
+
+def describe():
+    def output(command):
+        try:
+            return subprocess.run(
+                command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True
+            ).stdout.decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    ffmpeg = output(["ffmpeg", "-version"])
+    return dict(
+        commit=output(["git", "rev-parse", "HEAD"]),
+        ffmpeg=ffmpeg.splitlines()[0] if ffmpeg else None,
+        time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--speakers", choices=list(RESOLUTIONS), nargs="+", default=list(RESOLUTIONS)
+    )
+    parser.add_argument("--stages", choices=STAGES, nargs="+", default=STAGES)
+    parser.add_argument("--duration", type=float, default=30, help="Seconds per cut")
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--sample_rate", type=int, default=16000)
+    parser.add_argument("--frame_format", default="jpg")
+    parser.add_argument("--s3fd", action="store_true", help="Detect with s3fd on the cpu")
+    parser.add_argument(
+        "--out", type=Path, default=None, help="JSON output, stdout if not given"
+    )
+    parser.add_argument("--dir", type=Path, default=None)
+    args = parser.parse_args()
+
+    context = mp.get_context("spawn")
+    results = {}
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        tmp = Path(tmp)
+        for speaker in args.speakers:
+            source = tmp / "media" / f"{speaker}.mp4"
+            make_cut(source, RESOLUTIONS[speaker], args.duration, args.fps)
+            for stage in args.stages:
+                args.root = tmp / f"{stage}-{speaker}"
+                mp4 = copy_cut(source, args.root, speaker)
+                with context.Pool(1) as pool:
+                    result = pool.apply(run_stage, (stage, mp4, speaker, args))
+                results.setdefault(stage, {})[speaker] = result
+                print(f"==> {stage} {speaker}: {result}")
+
+    report = dict(**describe(), args=vars(args), results=results)
+    report["args"] = {key: str(value) for key, value in report["args"].items()}
+    text = json.dumps(report, indent=2)
+    if args.out is None:
+        print(text)
+    else:
+        args.out.write_text(text)
+
+
+if __name__ == "__main__":
+    main()
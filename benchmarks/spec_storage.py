@@ -0,0 +1,104 @@
+"""
+Write throughput and read latency of each spectrogram storage format, on
+random spectrograms shaped like those of 30 s intervals.
+
+    python benchmarks/spec_storage.py --cuts 64
+"""
+import json
+import time
+import random
+import argparse
+import tempfile
+import numpy as np
+from pathlib import Path
+
+from lip2wav_dataset.storage import (
+    SPEC_FORMATS,
+    ConsolidatedSpecs,
+    consolidate,
+    load_specs,
+    save_specs,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cuts", type=int, default=32)
+    parser.add_argument("--steps", type=int, default=2400, help="30 s at hop 200, 16 kHz")
+    parser.add_argument("--num_mels", type=int, default=80)
+    parser.add_argument("--num_freq", type=int, default=401)
+    parser.add_argument("--window", type=int, default=240, help="Steps per read")
+    parser.add_argument("--reads", type=int, default=1000)
+    parser.add_argument("--dir", type=Path, default=None)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    specs = [
+        (
+            rng.uniform(-4, 4, (args.num_mels, args.steps)).astype(np.float32),
+            rng.uniform(-4, 4, (args.num_freq, args.steps)).astype(np.float32),
+        )
+        for _ in range(args.cuts)
+    ]
+    nbytes = sum(spec.nbytes + lspec.nbytes for spec, lspec in specs)
+
+    results = {}
+    with tempfile.TemporaryDirectory(dir=args.dir) as root:
+        for spec_format in SPEC_FORMATS:
+            directories = [
+                Path(root, spec_format, "video", f"cut-{i}") for i in range(args.cuts)
+            ]
+            for directory in directories:
+                directory.mkdir(parents=True)
+
+            start = time.perf_counter()
+            for directory, (spec, lspec) in zip(directories, specs):
+                save_specs(directory, spec, lspec, spec_format)
+            if spec_format == "memmap":
+                consolidate(directories, Path(root, spec_format, "specs-test"))
+            write_time = time.perf_counter() - start
+
+            size = sum(p.stat().st_size for p in Path(root, spec_format).rglob("*.*"))
+
+            if spec_format == "memmap":
+                specs_file = ConsolidatedSpecs(Path(root, spec_format, "specs-test"))
+
+                def read(i, offset):
+                    key = ("video", i, offset, offset + args.window)
+                    return specs_file[key]
+
+            else:
+
+                def read(i, offset):
+                    mels = load_specs(directories[i])
+                    return {
+                        name: mels[name][:, offset : offset + args.window]
+                        for name in mels
+                    }
+
+            random.seed(0)
+            latencies = []
+            for _ in range(args.reads):
+                i = random.randrange(args.cuts)
+                offset = random.randrange(args.steps - args.window)
+                start = time.perf_counter()
+                window = read(i, offset)
+                # touch the data so that memory-mapped reads are counted too
+                for array in window.values():
+                    np.asarray(array, np.float32).sum()
+                latencies.append(time.perf_counter() - start)
+
+            latencies = np.array(latencies) * 1000
+            results[spec_format] = dict(
+                write_mb_per_s=nbytes / 2 ** 20 / write_time,
+                size_mb=size / 2 ** 20,
+                read_ms_mean=float(latencies.mean()),
+                read_ms_p50=float(np.percentile(latencies, 50)),
+                read_ms_p99=float(np.percentile(latencies, 99)),
+            )
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Startup time and RSS of each subcommand, measured on `--help`, and a check
+that importing a subcommand does not load the heavy dependencies. Exits with
+1 when a limit is exceeded, so it can guard against startup regressions:
+
+    python benchmarks/startup.py --max_seconds 2
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+from lip2wav_dataset.cli import COMMANDS
+
+# only loaded by the code paths that need them
+HEAVY = ["torch", "efd", "tensorflow", "matplotlib", "librosa"]
+
+
+def measure(command):
+    """Returns (seconds, peak RSS in MB) of a command"""
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    if os.WIFEXITED(status):
+        process.returncode = os.WEXITSTATUS(status)
+    else:
+        process.returncode = -os.WTERMSIG(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    # kilobytes on linux
+    return elapsed, rusage.ru_maxrss / 1024
+
+
+def heavy_imports(command):
+    code = (
+        "import sys, json, importlib\n"
+        f"importlib.import_module('lip2wav_dataset.{command}')\n"
+        f"print(json.dumps([m for m in {HEAVY!r} if m in sys.modules]))\n"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], stdout=subprocess.PIPE, check=True
+    ).stdout
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--commands", choices=list(COMMANDS), nargs="+", default=list(COMMANDS)
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="The best run is kept")
+    parser.add_argument("--max_seconds", type=float, default=3.0)
+    parser.add_argument("--max_rss_mb", type=float, default=300)
+    args = parser.parse_args()
+
+    results = {}
+    failures = []
+    for command in args.commands:
+        runs = [
+            measure([sys.executable, "-m", "lip2wav_dataset", command, "--help"])
+            for _ in range(args.repeat)
+        ]
+        seconds = min(seconds for seconds, _ in runs)
+        rss = min(rss for _, rss in runs)
+        heavy = heavy_imports(command)
+        results[command] = dict(seconds=seconds, peak_rss_mb=rss, heavy_imports=heavy)
+        if seconds > args.max_seconds:
+            failures.append(f"{command} --help took {seconds:.2f}s")
+        if rss > args.max_rss_mb:
+            failures.append(f"{command} --help used {rss:.0f}MB")
+        if heavy:
+            failures.append(f"importing {command} loads {', '.join(heavy)}")
+
+    print(json.dumps(results, indent=2))
+    for failure in failures:
+        print(f"==> FAILED: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
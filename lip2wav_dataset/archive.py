@@ -0,0 +1,152 @@
+import cv2
+import threading
+import numpy as np
+from pathlib import Path
+
+from . import metrics
+from .utils import atomic_path
+
+FRAME_FORMATS = ["jpg", "archive"]
+
+INDEX_DTYPE = np.dtype([("frame_id", "<i4"), ("offset", "<i8"), ("length", "<i4")])
+
+
+class JpegDirectory:
+    """
+    One {frame_id}.jpg per face crop, the original layout.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+
+    def write(self, frame_id, image):
+        if not cv2.imwrite(str(self.directory / f"{frame_id}.jpg"), image):
+            raise IOError(f"Failed to write {self.directory / f'{frame_id}.jpg'}.")
+        metrics.count_file("frames.bytes_written", self.directory / f"{frame_id}.jpg")
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    @property
+    def frame_ids(self):
+        return sorted(int(path.stem) for path in self.directory.glob("*.jpg"))
+
+    def __contains__(self, frame_id):
+        return (self.directory / f"{frame_id}.jpg").exists()
+
+    def __getitem__(self, frame_id):
+        """Returns the encoded jpg"""
+        data = (self.directory / f"{frame_id}.jpg").read_bytes()
+        return np.frombuffer(data, np.uint8)
+
+    def image(self, frame_id):
+        return cv2.imdecode(self[frame_id], cv2.IMREAD_COLOR)
+
+
+class FrameArchiveWriter:
+    """
+    Packs the jpgs of a cut into frames.bin, with an index of (frame_id, offset,
+    length) in frames.idx.npy written on flush and close. Images are encoded
+    outside the lock, so several threads can write to the same archive.
+
+    With start, the frames before start indexed by the last flush are kept and
+    the data written after them is dropped.
+    """
+
+    def __init__(self, directory, start=0):
+        self.directory = Path(directory)
+        self.index = []
+        self.lock = threading.Lock()
+        index_path = self.directory / "frames.idx.npy"
+        if start > 0 and index_path.exists():
+            index = np.load(index_path).tolist()
+            self.index = [tuple(row) for row in index if row[0] < start]
+            end = max((offset + length for _, offset, length in self.index), default=0)
+            self.file = open(self.directory / "frames.bin", "r+b")
+            self.file.truncate(end)
+            self.file.seek(end)
+        else:
+            self.file = open(self.directory / "frames.bin", "wb")
+
+    def write(self, frame_id, image):
+        success, data = cv2.imencode(".jpg", image)
+        if not success:
+            raise IOError(f"Failed to encode frame {frame_id}.")
+        with self.lock:
+            self.index.append((frame_id, self.file.tell(), len(data)))
+            self.file.write(data.tobytes())
+        metrics.count("frames.bytes_written", len(data))
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+            index = np.array(sorted(self.index), dtype=INDEX_DTYPE)
+        with atomic_path(self.directory / "frames.idx.npy") as tmp:
+            with open(tmp, "wb") as f:
+                np.save(f, index)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class FrameArchive:
+    """
+    Random access by frame_id to a frames.bin archive. The data is memory-mapped,
+    indexing returns the encoded jpg without copying it.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.index = np.load(self.directory / "frames.idx.npy")
+        path = self.directory / "frames.bin"
+        if path.stat().st_size > 0:
+            self.data = np.memmap(path, np.uint8, mode="r")
+        else:
+            self.data = np.zeros(0, np.uint8)
+        self.positions = {int(frame_id): i for i, frame_id in enumerate(self.frame_ids)}
+
+    @property
+    def frame_ids(self):
+        return self.index["frame_id"]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, frame_id):
+        return frame_id in self.positions
+
+    def __getitem__(self, frame_id):
+        """Returns the encoded jpg"""
+        _, offset, length = self.index[self.positions[frame_id]]
+        return self.data[offset : offset + length]
+
+    def image(self, frame_id):
+        return cv2.imdecode(self[frame_id], cv2.IMREAD_COLOR)
+
+
+def create_frame_writer(directory, frame_format, start=0):
+    """start: resume the crops written to directory before this frame"""
+    if frame_format == "jpg":
+        return JpegDirectory(directory)
+    elif frame_format == "archive":
+        return FrameArchiveWriter(directory, start)
+    raise ValueError(f"Unknown frame format {frame_format}.")
+
+
+def clear_frames(directory):
+    """Removes the face crops of a cut, in any format"""
+    directory = Path(directory)
+    for path in [*directory.glob("*.jpg"), directory / "frames.bin", directory / "frames.idx.npy"]:
+        if path.exists():
+            path.unlink()
+
+
+def open_frames(directory):
+    """Opens the face crops of a cut for reading, whichever format they are in"""
+    if (Path(directory) / "frames.idx.npy").exists():
+        return FrameArchive(directory)
+    return JpegDirectory(directory)
@@ -2,10 +2,12 @@
 This script is from https://github.com/Rudrabha/Lip2Wav/blob/95d923f130e4cce93fdffbf67d2ec2d66eef933a/synthesizer/audio.py for spectrogram calculation.
 """
 
+import pickle
 import librosa
 import librosa.filters
 import numpy as np
-import tensorflow as tf
+from collections import OrderedDict
+from pathlib import Path
 from scipy import signal
 from scipy.io import wavfile
 
@@ -14,6 +16,18 @@ def load_wav(path, sr):
     return librosa.core.load(path, sr=sr)[0]
 
 
+def pcm_to_wav(pcm, pcm_sr, sr):
+    """Same as load_wav on the int16 samples (n c) of a wav file"""
+    wav = pcm.astype(np.float32) / 32768
+    if wav.shape[1] > 1:
+        wav = np.mean(wav, axis=1)
+    else:
+        wav = wav[:, 0]
+    if pcm_sr != sr:
+        wav = librosa.resample(wav, orig_sr=pcm_sr, target_sr=sr)
+    return wav
+
+
 def save_wav(wav, path, sr):
     wav *= 32767 / max(0.01, np.max(np.abs(wav)))
     # proposed by @dsmiller
@@ -77,6 +91,33 @@ def melspectrogram(wav, hparams):
     return S
 
 
+def spectrograms(wavs, hparams):
+    """Computes (mel, linear) spectrograms for a list of waveforms
+
+    Pre-emphasis and the STFT run once per waveform, both outputs are derived
+    from the same magnitude which is converted in place.
+    """
+    outputs = []
+    for wav in wavs:
+        S = np.abs(
+            _stft(preemphasis(wav, hparams.preemphasis, hparams.preemphasize), hparams)
+        )
+        M = _linear_to_mel(S, hparams)
+        M = _amp_to_normalized_db_(M, hparams)
+        S = _amp_to_normalized_db_(S, hparams)
+        outputs.append((M, S))
+    return outputs
+
+
+def _amp_to_normalized_db_(S, hparams):
+    """In-place equivalent of _normalize(_amp_to_db(S) - ref_level_db)"""
+    _amp_to_db_(S, hparams)
+    S -= hparams.ref_level_db
+    if hparams.signal_normalization:
+        _normalize_(S, hparams)
+    return S
+
+
 def inv_linear_spectrogram(linear_spectrogram, hparams):
     """Converts linear spectrogram to waveform using librosa"""
     if hparams.signal_normalization:
@@ -153,6 +194,7 @@ def _stft(y, hparams):
             n_fft=hparams.n_fft,
             hop_length=get_hop_size(hparams),
             win_length=hparams.win_size,
+            window=_stft_window(hparams),
         )
 
 
@@ -190,22 +232,98 @@ def librosa_pad_lr(x, fsize, fshift):
 
 
 # Conversions
-_mel_basis = None
-_inv_mel_basis = None
+_cache = OrderedDict()
+_cache_maxsize = 16
+_cache_hits = 0
+_cache_misses = 0
+
+
+def _cached(key, build):
+    """Bounded LRU lookup, the key must contain every hparam used by build()"""
+    global _cache_hits, _cache_misses
+    if key in _cache:
+        _cache_hits += 1
+        _cache.move_to_end(key)
+        return _cache[key]
+    _cache_misses += 1
+    value = build()
+    _cache[key] = value
+    while len(_cache) > _cache_maxsize:
+        _cache.popitem(last=False)
+    return value
+
+
+def cache_info():
+    return dict(
+        hits=_cache_hits,
+        misses=_cache_misses,
+        size=len(_cache),
+        maxsize=_cache_maxsize,
+    )
+
+
+def save_cache(path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.tmp")
+    with open(tmp, "wb") as f:
+        pickle.dump(dict(_cache), f)
+    tmp.replace(path)
+
+
+def load_cache(path):
+    path = Path(path)
+    if not path.exists():
+        return
+    with open(path, "rb") as f:
+        for key, value in pickle.load(f).items():
+            if key not in _cache:
+                _cache[key] = value
+    while len(_cache) > _cache_maxsize:
+        _cache.popitem(last=False)
+
+
+def warmup_cache(hparams):
+    """Builds everything the forward transforms need"""
+    _stft_window(hparams)
+    _mel_basis(hparams)
+
+
+def _mel_key(hparams):
+    return (
+        hparams.sample_rate,
+        hparams.n_fft,
+        hparams.num_mels,
+        hparams.fmin,
+        hparams.fmax,
+    )
+
+
+def _mel_basis(hparams):
+    return _cached(("mel", *_mel_key(hparams)), lambda: _build_mel_basis(hparams))
+
+
+def _inv_mel_basis(hparams):
+    return _cached(
+        ("inv_mel", *_mel_key(hparams)),
+        lambda: np.linalg.pinv(_mel_basis(hparams)),
+    )
+
+
+def _stft_window(hparams):
+    win_size = hparams.win_size or hparams.n_fft
+    return _cached(
+        ("window", win_size),
+        lambda: librosa.filters.get_window("hann", win_size, fftbins=True),
+    )
 
 
 def _linear_to_mel(spectogram, hparams):
-    global _mel_basis
-    if _mel_basis is None:
-        _mel_basis = _build_mel_basis(hparams)
-    return np.dot(_mel_basis, spectogram)
+    return np.dot(_mel_basis(hparams), spectogram)
 
 
 def _mel_to_linear(mel_spectrogram, hparams):
-    global _inv_mel_basis
-    if _inv_mel_basis is None:
-        _inv_mel_basis = np.linalg.pinv(_build_mel_basis(hparams))
-    return np.maximum(1e-10, np.dot(_inv_mel_basis, mel_spectrogram))
+    return np.maximum(1e-10, np.dot(_inv_mel_basis(hparams), mel_spectrogram))
 
 
 def _build_mel_basis(hparams):
@@ -224,6 +342,14 @@ def _amp_to_db(x, hparams):
     return 20 * np.log10(np.maximum(min_level, x))
 
 
+def _amp_to_db_(x, hparams):
+    min_level = np.exp(hparams.min_level_db / 20 * np.log(10))
+    np.maximum(min_level, x, out=x)
+    np.log10(x, out=x)
+    x *= 20
+    return x
+
+
 def _db_to_amp(x):
     return np.power(10.0, (x) * 0.05)
 
@@ -257,6 +383,23 @@ def _normalize(S, hparams):
         )
 
 
+def _normalize_(S, hparams):
+    if not hparams.allow_clipping_in_normalization:
+        assert S.max() <= 0 and S.min() - hparams.min_level_db >= 0
+    S -= hparams.min_level_db
+    S /= -hparams.min_level_db
+    if hparams.symmetric_mels:
+        S *= 2 * hparams.max_abs_value
+        S -= hparams.max_abs_value
+        lower = -hparams.max_abs_value
+    else:
+        S *= hparams.max_abs_value
+        lower = 0
+    if hparams.allow_clipping_in_normalization:
+        np.clip(S, lower, hparams.max_abs_value, out=S)
+    return S
+
+
 def _denormalize(D, hparams):
     if hparams.allow_clipping_in_normalization:
         if hparams.symmetric_mels:
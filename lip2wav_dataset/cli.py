@@ -0,0 +1,39 @@
+import sys
+import importlib
+
+# subcommand -> description, the module of a subcommand is only imported when it runs
+COMMANDS = {
+    "download": "Download raw videos from YouTube",
+    "cut": "Cut raw videos into intervals",
+    "detect": "Detect faces from the intervals",
+    "collect": "Merge the detections of each speaker/split",
+    "prepare": "Generate frames, audios and spectrograms",
+    "export": "Export training shards",
+    "run": "Stream each video through all the steps",
+}
+
+
+def usage():
+    lines = ["usage: lip2wav-dataset <command> ...", "", "commands:"]
+    width = max(map(len, COMMANDS))
+    for command, description in COMMANDS.items():
+        lines.append(f"  {command.ljust(width)}  {description}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ["-h", "--help"]:
+        print(usage())
+        return
+    command, *rest = argv
+    if command not in COMMANDS:
+        print(f"Unknown command {command}.\n\n{usage()}", file=sys.stderr)
+        sys.exit(2)
+    module = importlib.import_module(f".{command}", __package__)
+    sys.argv = [f"lip2wav-dataset {command}", *rest]
+    module.main()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,81 +1,224 @@
+import os
 import tqdm
-import cv2
-import sys
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from itertools import product
-from collections import defaultdict
 from pathlib import Path
 
-from .utils import create_parser, get_filelist
+from . import metrics
+from .manifest import Manifest
+from .utils import create_parser, out_dir, read_split
 
 
-def get_resolution(path):
-    cap = cv2.VideoCapture(str(path))
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    return (width, height)
+def get_resolution_df(root, speaker, split, manifest):
+    """
+    Probes the raw videos, the videos removed once cut (e.g. by run) take the
+    resolution of their intervals from the manifest.
+    """
+    video_dir = root / speaker / "videos"
+    youtube_ids = set(read_split(root, speaker, split))
+    paths = []
+    if video_dir.exists():
+        paths = [
+            Path(entry.path)
+            for entry in os.scandir(video_dir)
+            if entry.name.endswith(".mp4") and entry.name[:-4] in youtube_ids
+        ]
+    infos = manifest.probe_all(paths)
+    resolutions = {
+        path.stem: (info["width"], info["height"]) for path, info in zip(paths, infos)
+    }
+    missing = youtube_ids - set(resolutions)
+    if missing:
+        resolutions.update(manifest.resolutions(speaker, missing))
+    return pd.DataFrame(
+        [
+            {"youtube_id": youtube_id, "width": width, "height": height}
+            for youtube_id, (width, height) in resolutions.items()
+        ],
+        columns=["youtube_id", "width", "height"],
+    )
 
 
-def get_resolution_df(root, speaker, split):
-    rows = []
-    paths = list(
-        get_filelist(
-            root,
-            speaker,
-            split,
-            "videos/**/{youtube_id}.mp4",
-        )
-    )
-    for path in paths:
-        rows.append(
-            {
-                "youtube_id": path.stem,
-                "resolution": get_resolution(path),
-            }
-        )
-    return pd.DataFrame(rows)
+# detection.csv keeps 4 decimals, so columnar formats store the bbox exactly as
+# int16 in units of 1e-4 instead of rounding it to float32
+BBOX_COLUMNS = ["x1", "y1", "x2", "y2"]
+BBOX_SCALE = 10000
 
+DTYPES = {
+    **{column: "float64" for column in BBOX_COLUMNS},
+    "frame_id": "int16",
+    "cut": "int16",
+    "width": "int16",
+    "height": "int16",
+}
 
-def get_detection_df(root, speaker, split):
-    dfs = []
-    paths = list(
-        get_filelist(
-            root,
-            speaker,
-            split,
-            "preprocessed/{youtube_id}/**/*.csv",
-        )
-    )
-    for path in paths:
+FORMATS = ["csv", "parquet", "feather", "npy"]
+
+
+def astype(df):
+    return df.astype({column: dtype for column, dtype in DTYPES.items() if column in df})
+
+
+def read_detection_csv(path):
+    """
+    Reads the detection.csv of a cut, None if it is corrupt. detect writes an
+    empty file for a cut without faces, which reads as no detections.
+    """
+    try:
+        df = pd.read_csv(path, dtype=DTYPES)
+    except pd.errors.EmptyDataError:
+        df = astype(pd.DataFrame(columns=["frame_id", *BBOX_COLUMNS]))
+    except ValueError as e:
+        # a parser error, or e.g. a frame_id that is not an int16
+        print(f"==> WARNING: Failed to read {path}: {e}")
+        return None
+    df["youtube_id"] = path.parts[-3]
+    df["cut"] = np.int16(path.parts[-2].replace("cut-", ""))
+    return df
+
+
+def read_detection_df(path):
+    """
+    Reads a merged detection file in any of FORMATS, legacy csvs with a
+    stringified resolution tuple are converted to width and height columns.
+    """
+    path = Path(path)
+    if path.suffix == ".csv":
+        df = pd.read_csv(path, dtype={**DTYPES, "youtube_id": str})
+        if "resolution" in df:
+            resolution = df.pop("resolution").str.extract(r"(\d+)\D+(\d+)")
+            df["width"] = resolution[0].astype("int16")
+            df["height"] = resolution[1].astype("int16")
+        return astype(df)
+    if path.suffix == ".parquet":
+        df = pd.read_parquet(path)
+    elif path.suffix == ".feather":
+        df = pd.read_feather(path)
+    elif path.suffix == ".npy":
+        df = pd.DataFrame(np.load(path))
+        df["youtube_id"] = df["youtube_id"].astype(str)
+    else:
+        raise ValueError(f"Unknown detection format {path.suffix}.")
+    for column in BBOX_COLUMNS:
+        df[column] = df[column] / BBOX_SCALE
+    return astype(df)
+
+
+def write_detection_df(df, path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.suffix == ".csv":
+        df.to_csv(path, index=None)
+        return
+    df = df.copy()
+    for column in BBOX_COLUMNS:
+        df[column] = np.round(df[column] * BBOX_SCALE).astype("int16")
+    if path.suffix == ".parquet":
+        df.to_parquet(path, index=False)
+    elif path.suffix == ".feather":
+        df.to_feather(path)
+    elif path.suffix == ".npy":
+        columns = [df[column].to_numpy() for column in df.columns]
+        columns = [c.astype(str) if c.dtype == object else c for c in columns]
+        np.save(path, np.rec.fromarrays(columns, names=list(df.columns)))
+    else:
+        raise ValueError(f"Unknown detection format {path.suffix}.")
+
+
+def get_detection_df(root, speaker, split, manifest, output, workers=16):
+    """
+    Merges the detection.csv of every cut into output, only the csvs changed
+    since the last collect are read again.
+    """
+    manifest.update(speaker, split)
+    mtimes = {}
+    removed = []
+    for mp4 in manifest.intervals(speaker, split, "detected", done=True):
+        path = out_dir(mp4) / "detection.csv"
         try:
-            df = pd.read_csv(path)
-        except Exception as e:
-            continue
-        df["youtube_id"] = path.parts[-3]
-        df["cut"] = path.parts[-2].replace("cut-", "")
-        dfs.append(df)
-    if not dfs:
+            mtimes[str(path)] = path.stat().st_mtime
+        except FileNotFoundError:
+            removed.append(mp4)
+    # the detections were deleted, detect lists these intervals again
+    manifest.mark_all(removed, "detected", done=False)
+
+    previous = None
+    if output.exists():
+        collected = manifest.collected(output)
+        previous = read_detection_df(output)
+    else:
+        collected = {}
+    changed = [Path(p) for p, mtime in mtimes.items() if collected.get(p) != mtime]
+
+    with metrics.timer("collect.read"), ThreadPoolExecutor(workers) as executor:
+        dfs = [df for df in executor.map(read_detection_csv, changed) if df is not None]
+    if metrics.enabled():
+        for path in changed:
+            metrics.count_file("collect.bytes_read", path)
+
+    if previous is not None:
+        changed_set = set(changed)
+        kept = set(
+            (Path(p).parts[-3], int(Path(p).parts[-2].replace("cut-", "")))
+            for p in mtimes
+            if Path(p) not in changed_set
+        )
+        index = pd.MultiIndex.from_frame(previous[["youtube_id", "cut"]])
+        previous = previous[index.isin(kept)]
+
+    if not dfs and (previous is None or previous.empty):
         raise FileNotFoundError(f"No detection is found for {speaker}/{split}.")
-    df = pd.concat(dfs).reset_index(drop=True)
-    return df
+    return dfs, previous, mtimes
 
 
 def main():
     parser = create_parser()
+    parser.add_argument(
+        "--format",
+        help="Format of the merged detection/{speaker}-{split} file",
+        choices=FORMATS,
+        default="csv",
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of threads reading the detection.csv files",
+        default=16,
+        type=int,
+    )
+    metrics.add_metrics_arguments(parser)
     args = parser.parse_args()
+    reporter = metrics.start(args)
+    manifest = Manifest(args.root)
     pbar = tqdm.tqdm(list(product(args.speakers, args.splits)))
     for speaker, split in pbar:
         pbar.set_description_str(f"Collecting {speaker}/{split} ...")
+        path = Path(f"detection/{speaker}-{split}.{args.format}")
         try:
-            bdf = get_detection_df(args.root, speaker, split)
+            dfs, previous, mtimes = get_detection_df(
+                args.root, speaker, split, manifest, path, args.workers
+            )
         except FileNotFoundError as e:
             print(f"{e} Skipped.")
             continue
-        rdf = get_resolution_df(args.root, speaker, split)
-        df = pd.merge(bdf, rdf, on="youtube_id")
-        path = Path(f"detection/{speaker}-{split}.csv")
-        path.parent.mkdir(parents=True, exist_ok=True)
-        df.to_csv(path, index=None)
+        if dfs:
+            with metrics.timer("collect.probe"):
+                rdf = get_resolution_df(args.root, speaker, split, manifest)
+            dfs = [pd.merge(pd.concat(dfs), rdf, on="youtube_id")]
+        if previous is not None:
+            dfs.insert(0, previous)
+        with metrics.timer("collect.merge"):
+            df = astype(pd.concat(dfs))
+            df = df.sort_values(["youtube_id", "cut", "frame_id"])
+            df = df.reset_index(drop=True)
+        with metrics.timer("collect.write"):
+            write_detection_df(df, path)
+        metrics.count_file("collect.bytes_written", path)
+        manifest.set_collected(path, mtimes)
+    manifest.close()
+    if reporter is not None:
+        reporter.close()
 
 
 if __name__ == "__main__":
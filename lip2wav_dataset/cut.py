@@ -0,0 +1,209 @@
+import math
+import tqdm
+import shlex
+import argparse
+import subprocess
+from multiprocessing import Pool
+from itertools import product
+from pathlib import Path
+
+from .collect import read_detection_df
+from .manifest import Manifest
+from .media import probe
+from .utils import atomic_path, create_parser, read_split
+
+SEGMENT_TIME = 30
+
+STREAMER = "youtube-dl -q -f best -o - -- {youtube_id}"
+
+
+def segment_command(source, directory, limit=None):
+    command = ["ffmpeg", "-loglevel", "panic", "-i", source]
+    if limit is not None:
+        command += ["-t", str(limit)]
+    command += [
+        *("-acodec", "copy", "-f", "segment", "-vcodec", "copy"),
+        *("-reset_timestamps", "1", "-map", "0", "-segment_time", str(SEGMENT_TIME)),
+        str(directory / "cut-%d.mp4"),
+    ]
+    return command
+
+
+def is_complete(idir, duration, needed=None):
+    """
+    Whether all the segments of a video are found in idir. Segments are split
+    at the first keyframe after each boundary, so the count may be one less
+    than duration / SEGMENT_TIME. The last segment is probed, an interrupted
+    ffmpeg leaves it without the moov atom.
+    """
+    if not idir.is_dir():
+        return False
+    cuts = sorted(
+        int(path.stem.split("-")[-1]) for path in idir.glob("cut-*.mp4")
+    )
+    if needed is not None:
+        found = set(cuts)
+        if not needed <= found:
+            return False
+        last = max(needed)
+    else:
+        if not cuts or cuts != list(range(len(cuts))):
+            return False
+        if not math.isnan(duration):
+            expected = math.ceil(duration / SEGMENT_TIME)
+            if len(cuts) < expected - 1:
+                return False
+        last = cuts[-1]
+    try:
+        probe(idir / f"cut-{last}.mp4")
+    except (subprocess.CalledProcessError, ValueError, KeyError):
+        return False
+    return True
+
+
+def cut_video(job):
+    """
+    Cuts a video into intervals/{id}/cut-N.mp4 through a temporary directory
+    that is renamed into place when ffmpeg succeeds. With needed cuts, ffmpeg
+    stops after the last one and the others are removed.
+
+    Errors are returned instead of raised so that one broken video does not
+    stop the whole run.
+    """
+    youtube_id, source, idir, needed, args = job
+    limit = None
+    if needed is not None:
+        # one more segment, as the last needed one may run past its boundary
+        limit = (max(needed) + 2) * SEGMENT_TIME
+    try:
+        with atomic_path(idir) as tmp:
+            tmp.mkdir(parents=True)
+            if source is None:
+                streamer = subprocess.Popen(
+                    shlex.split(args.streamer.format(youtube_id=youtube_id)),
+                    stdout=subprocess.PIPE,
+                )
+                try:
+                    subprocess.run(
+                        segment_command("pipe:0", tmp, limit),
+                        stdin=streamer.stdout,
+                        check=True,
+                    )
+                finally:
+                    streamer.stdout.close()
+                    # the streamer gets a broken pipe when ffmpeg stops at the limit
+                    returncode = streamer.wait()
+                if returncode != 0 and limit is None:
+                    raise subprocess.CalledProcessError(returncode, streamer.args)
+            else:
+                subprocess.run(segment_command(str(source), tmp, limit), check=True)
+            if needed is not None:
+                for path in tmp.glob("cut-*.mp4"):
+                    if int(path.stem.split("-")[-1]) not in needed:
+                        path.unlink()
+    except Exception as e:
+        return youtube_id, e
+    return youtube_id, None
+
+
+def get_needed(detection):
+    """{youtube_id: set of cuts} with a face detected"""
+    df = read_detection_df(detection)
+    return {
+        youtube_id: set(group["cut"].unique().tolist())
+        for youtube_id, group in df.groupby("youtube_id")
+    }
+
+
+def list_jobs(root, speaker, split, manifest, needed, args):
+    youtube_ids = read_split(root, speaker, split)
+    if needed is not None:
+        youtube_ids = [i for i in youtube_ids if i in needed]
+
+    video_dir = root / speaker / "videos"
+    mp4s = [video_dir / f"{youtube_id}.mp4" for youtube_id in youtube_ids]
+    local = [mp4 for mp4 in mp4s if mp4.exists()]
+    infos = dict(zip(local, manifest.probe_all(local)))
+
+    jobs = []
+    for youtube_id, mp4 in zip(youtube_ids, mp4s):
+        idir = root / speaker / "intervals" / youtube_id
+        cuts = None if needed is None else needed[youtube_id]
+        if mp4 in infos:
+            if is_complete(idir, infos[mp4]["duration"], cuts):
+                continue
+            jobs.append((youtube_id, mp4, idir, cuts, args))
+        elif args.stream:
+            if is_complete(idir, float("nan"), cuts):
+                continue
+            jobs.append((youtube_id, None, idir, cuts, args))
+    return jobs
+
+
+def main():
+    parser = create_parser()
+    # the former bash command took the root as its only argument
+    parser.add_argument("legacy_root", type=Path, nargs="?", help=argparse.SUPPRESS)
+    parser.add_argument(
+        "--workers",
+        help="Number of videos cut in parallel",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--detections",
+        help="Only cut the intervals with a face in these detection files, "
+        "named {speaker}-{split}",
+        type=Path,
+        nargs="+",
+        default=None,
+    )
+    parser.add_argument(
+        "--stream",
+        help="Cut videos not downloaded (yet) straight from a stream",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--streamer",
+        help="Command writing the video {youtube_id} to stdout",
+        default=STREAMER,
+    )
+    args = parser.parse_args()
+    if args.legacy_root is not None:
+        args.root = args.legacy_root
+
+    if args.detections is not None:
+        pairs = [
+            (detection.stem.split("-"), detection) for detection in args.detections
+        ]
+    else:
+        pairs = [(pair, None) for pair in product(args.speakers, args.splits)]
+
+    manifest = Manifest(args.root)
+    jobs = []
+    for (speaker, split), detection in pairs:
+        if not (args.root / speaker / split).with_suffix(".txt").exists():
+            continue
+        needed = None if detection is None else get_needed(detection)
+        jobs.extend(list_jobs(args.root, speaker, split, manifest, needed, args))
+    manifest.close()
+
+    if args.workers > 1:
+        pool = Pool(args.workers)
+        results = pool.imap_unordered(cut_video, jobs)
+    else:
+        pool = None
+        results = map(cut_video, jobs)
+
+    try:
+        for youtube_id, error in tqdm.tqdm(results, total=len(jobs), desc="Cutting"):
+            if error is not None:
+                print(f"==> ERROR: Failed to cut {youtube_id}: {error}")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,28 @@
 import tqdm
-import torch
 import numpy as np
 import pandas as pd
-import argparse, os, cv2, subprocess
-import torch.nn.functional as F
+import os, cv2
+import json
+import shutil
 import threading
-from queue import Queue
-from torch.utils.data import Dataset
+import time
+import multiprocessing as mp
+from queue import Empty, Full, Queue
 from pathlib import Path
-from functools import partial
 from itertools import product
-from more_itertools import chunked
-from efd import s3fd
 
-from .utils import create_parser, get_filelist
+from . import metrics
+from .archive import FRAME_FORMATS, clear_frames, create_frame_writer
+from .manifest import Manifest
+from .storage import config_hash
+from .utils import Lease, atomic_path, commit, create_parser, lease_path, out_dir
+
+# records the detector config and the interval the detections of a cut come from
+SIDECAR = "detection.json"
+
+# in the partial directory of a cut being detected
+PARTIAL_CSV = "detection.partial.csv"
+CHECKPOINT = "checkpoint.json"
 
 
 def crop_frames(frames, speaker):
@@ -59,98 +68,632 @@ def compute_relative_bbox(bbox, size, speaker):
     return bbox
 
 
-def out_dir(mp4, mkdir=False):
-    path = Path(str(mp4.with_suffix("")).replace("intervals", "preprocessed"))
-    if mkdir:
-        path.mkdir(parents=True, exist_ok=True)
-    return path
+def partial_path(mp4):
+    """
+    Crops and flushed bboxes of a cut being detected, renamed to out_dir once
+    complete. Unlike temp_path, it does not depend on the process, so that a
+    later run resumes from its checkpoint.
+    """
+    path = out_dir(mp4)
+    return path.with_name(f".{path.name}.partial")
+
+
+def detector_config(args):
+    return dict(detector="s3fd", scale_factor=args.scale_factor)
 
 
-class VideoFrameLoader(threading.Thread):
+def read_state(path):
+    try:
+        return json.loads(Path(path).read_text())
+    except FileNotFoundError:
+        return None
+
+
+def write_state(path, state):
+    with atomic_path(path) as tmp:
+        tmp.write_text(json.dumps(state, indent=2, sort_keys=True))
+
+
+def needs_detection(mp4, config):
     """
-    This loader prefetches frames, faster than only calling cap.read() when needed.
+    Whether a cut has no detections, or detections from another detector
+    config or another version of its interval. Detections saved before
+    sidecars existed are assumed to be up to date.
     """
+    directory = out_dir(mp4)
+    if not (directory / "detection.csv").exists():
+        return True
+    sidecar = read_state(directory / SIDECAR)
+    if sidecar is None or not mp4.exists():
+        # intervals deleted once detected keep their detections
+        return False
+    return (
+        sidecar["config"] != config_hash(config)
+        or sidecar["size"] != mp4.stat().st_size
+    )
 
-    def __init__(self, path, batch_size, prefetch=128):
-        super().__init__()
-        cap = cv2.VideoCapture(str(path))
-        self.height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        self.width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        self.cap = cap
-        self.batch_size = batch_size
-        self.queue = Queue(prefetch)
-        self.daemon = True
-        self.start()
+
+def bbox_frame(bboxes):
+    df = pd.DataFrame(bboxes)
+    df["frame_id"] = df["frame_id"].astype(int)
+    del df["score"]
+    return df
+
+
+def read_bboxes(path):
+    try:
+        return pd.read_csv(path)
+    except (FileNotFoundError, pd.errors.EmptyDataError):
+        return pd.DataFrame()
+
+
+class Cut:
+    """
+    Detection state of an interval.
+
+    Frames from start on are detected. The crops and bboxes are checkpointed
+    to the partial directory, with next_frame, so that an interrupted run,
+    or a run after the interval has grown, only detects the missing frames.
+    """
+
+    def __init__(self, mp4, speaker, lease_ttl, config):
+        self.mp4 = mp4
+        self.speaker = speaker
+        self.config = config
+        self.lease = Lease(lease_path(mp4), lease_ttl)
+        self.claimed = False
+        self.partial_dir = partial_path(mp4)
+        self.frames = None
+        self.frame_format = None
+        self.frame_size = None
+        self.bboxes = []  # detected since the last checkpoint
+        self.start = 0
+        self.keep = 0  # number of frames whose crops are kept in out_dir
+        self.next_frame = 0
+        self.num_frames = None  # known once the cut is fully decoded
+        self.queued = 0  # end of the frames queued by the reader
+        self.processed = 0
+        self.pending = 0  # crops queued to the writer and not written yet
+        self.error = None
 
     @property
-    def frame_size(self):
-        return (self.height, self.width)
+    def finished(self):
+        return (
+            self.num_frames is not None
+            and self.processed == self.num_frames - self.start
+        )
 
-    def run(self):
-        while True:
-            success, frame = self.cap.read()
-            if not success:
-                break
-            self.queue.put(frame)
-        self.queue.put(None)
+    def state(self):
+        return dict(
+            config=config_hash(self.config),
+            size=self.mp4.stat().st_size,
+            frame_format=self.frame_format,
+        )
 
-    def frame_iter(self):
-        while True:
-            ret = self.queue.get()
-            if ret is None:
-                break
-            yield ret
+    def resume(self, frame_format):
+        """
+        Opens the frame writer from the checkpoint of a previous run, or from
+        the existing detections if only frames were appended to the interval.
+        Returns False if the detections of the cut are up to date.
+        """
+        if not needs_detection(self.mp4, self.config):
+            return False
+        self.frame_format = frame_format
+        state = self.state()
+        checkpoint = read_state(self.partial_dir / CHECKPOINT)
+        if checkpoint is not None and all(checkpoint[k] == v for k, v in state.items()):
+            self.start = self.next_frame = checkpoint["next_frame"]
+            self.keep = checkpoint["keep"]
+            # drop the bboxes flushed after the checkpoint was written
+            df = read_bboxes(self.partial_dir / PARTIAL_CSV)
+            if not df.empty and df["frame_id"].max() >= self.start:
+                df = df[df["frame_id"] < self.start]
+                df.to_csv(self.partial_dir / PARTIAL_CSV, index=None, float_format="%.4f")
+            self.frames = create_frame_writer(self.partial_dir, frame_format, self.start)
+            return True
+        if self.partial_dir.exists():
+            shutil.rmtree(self.partial_dir)
+        self.partial_dir.mkdir(parents=True)
+        directory = out_dir(self.mp4)
+        sidecar = read_state(directory / SIDECAR)
+        if (
+            sidecar is not None
+            and sidecar["config"] == state["config"]
+            and sidecar["frame_format"] == frame_format
+            and sidecar["size"] < state["size"]
+        ):
+            # the interval has grown, its first frames are already detected
+            self.start = self.next_frame = self.keep = sidecar["num_frames"]
+            df = read_bboxes(directory / "detection.csv")
+            if not df.empty:
+                df.to_csv(self.partial_dir / PARTIAL_CSV, index=None, float_format="%.4f")
+            if frame_format == "archive":
+                for name in ["frames.bin", "frames.idx.npy"]:
+                    shutil.copyfile(directory / name, self.partial_dir / name)
+        self.frames = create_frame_writer(self.partial_dir, frame_format, self.start)
+        return True
+
+    def checkpoint(self):
+        """Flushes the crops and bboxes before next_frame, the crops must be written"""
+        self.frames.flush()
+        if self.bboxes:
+            path = self.partial_dir / PARTIAL_CSV
+            bbox_frame(self.bboxes).to_csv(
+                path,
+                mode="a",
+                header=not path.exists(),
+                index=None,
+                float_format="%.4f",
+            )
+            self.bboxes = []
+        state = self.state()
+        state.update(keep=self.keep, next_frame=self.next_frame)
+        write_state(self.partial_dir / CHECKPOINT, state)
 
-    def __iter__(self):
-        return chunked(self.frame_iter(), self.batch_size)
 
+class Stopped(Exception):
+    pass
 
-def detect(model, mp4, args):
-    if (out_dir(mp4) / "detection.csv").exists():
-        # this video been processed by other running process
-        return
 
-    speaker = mp4.relative_to(args.root).parts[0]
+class VideoFrameLoader:
+    """
+    This loader prefetches frames, faster than only calling cap.read() when needed.
+
+    Several cuts are decoded concurrently, one reader thread each, and frames
+    of different cuts are packed into full batches by a packer thread. A batch
+    only holds frames of the same (pre-cropped) size. The packer copies frames
+    into a reusable (pinned when on cuda) buffer, reordered to rgb in the same
+    copy, so that only the non-blocking copy to the device and the scaling to
+    [0, 1] are left to the consuming thread.
+
+    A loader that is not iterated to the end must be closed, the threads would
+    otherwise block on the full queues.
+    """
 
-    data_loader = VideoFrameLoader(mp4, args.batch_size)
+    def __init__(
+        self,
+        cuts,
+        batch_size,
+        device,
+        concurrency=4,
+        prefetch=128,
+        frame_format="jpg",
+    ):
+        import torch
 
-    bboxes = []
+        self.batch_size = batch_size
+        self.frame_format = frame_format
+        self.device = torch.device(device)
+        self.todo = Queue()
+        for cut in cuts:
+            self.todo.put(cut)
+        self.queue = Queue(prefetch)
+        # buffers of each shape, the packer waits for a free one beyond this
+        self.num_buffers = max(2, prefetch // batch_size)
+        self.buffers = {}  # shape -> number of allocated buffers
+        self.free = {}  # shape -> Queue of (buffer, copied event)
+        self.batches = Queue()
+        self.stopped = threading.Event()
+        self.readers = [
+            threading.Thread(target=self.run, daemon=True) for _ in range(concurrency)
+        ]
+        for _ in self.readers:
+            self.todo.put(None)
+        for reader in self.readers:
+            reader.start()
+        self.packer = threading.Thread(target=self.pack, daemon=True)
+        self.packer.start()
+        self.finished = []
 
-    frame_id = -1
-    for images in tqdm.tqdm(data_loader, desc=f"Detecting {mp4}"):
-        images = torch.from_numpy(np.stack(images)).to(args.device)
-        images = crop_frames(images, speaker)  # pre-crop
-        images = images[..., [2, 1, 0]]  # bgr to rgb
-        images = (images / 255.0).permute(0, 3, 1, 2)  # numpy int8 to tensor float32
-        bbox_lists, patch_iters = model.detect(images, args.scale_factor)
-        for bbox_list, patch_iter in zip(bbox_lists, patch_iters):
-            frame_id += 1
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                cut = self.todo.get()
+                if cut is None:
+                    break
+                num_frames = 0
+                try:
+                    num_frames = self.read(cut)
+                except Exception as e:
+                    # the frames queued so far are still consumed, the cut is not saved
+                    cut.error = e
+                    num_frames = max(cut.queued, cut.start)
+                finally:
+                    self.put(self.queue, (cut, num_frames, None))
+        finally:
+            self.put(self.queue, None)
+
+    def put(self, queue, item):
+        """Puts an item, returns False if the loader is closed meanwhile"""
+        while not self.stopped.is_set():
             try:
-                face = next(patch_iter)
-                bbox = next(bbox_list.iterrows())[1]
-                bbox = compute_relative_bbox(bbox, data_loader.frame_size, speaker)
-                bbox["frame_id"] = frame_id
-                bboxes.append(bbox)
-                face = face * 255.0
-                face = face.permute(1, 2, 0).cpu().numpy()
-                face = face[..., [2, 1, 0]]  # rgb to bgr
-                cv2.imwrite(str(out_dir(mp4, True) / f"{frame_id}.jpg"), face)
-            except StopIteration:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
                 pass
+        return False
 
-    if bboxes:
-        df = pd.DataFrame(bboxes)
-        df["frame_id"] = df["frame_id"].astype(int)
-        del df["score"]
-    else:
-        # nothing is detected, create an empty csv
-        df = pd.DataFrame()
+    def get(self, queue):
+        """Gets an item, raises Stopped if the loader is closed meanwhile"""
+        while not self.stopped.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                pass
+        raise Stopped
+
+    def close(self):
+        """Stops the reader and packer threads"""
+        self.stopped.set()
+        for thread in [*self.readers, self.packer]:
+            thread.join()
+
+    def read(self, cut):
+        """Queues the frames of a cut from its start, returns the number of frames"""
+        cut.claimed = cut.lease.acquire()
+        if cut.claimed and not cut.resume(self.frame_format):
+            # finished by another running process meanwhile
+            cut.lease.release()
+            cut.claimed = False
+        if not cut.claimed:
+            return 0
+        metrics.count_file("detect.bytes_read", cut.mp4)
+        cap = cv2.VideoCapture(str(cut.mp4))
+        try:
+            cut.frame_size = (
+                int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            )
+            frame_id = 0
+            while frame_id < cut.start and cap.grab():
+                # already detected, skipped without decoding
+                frame_id += 1
+            while True:
+                with metrics.timer("detect.decode"):
+                    success, frame = cap.read()
+                if not success:
+                    break
+                frame = crop_frames(frame[None], cut.speaker)[0]
+                if not self.put(self.queue, (cut, frame_id, frame)):
+                    break
+                frame_id += 1
+                cut.queued = frame_id
+        finally:
+            cap.release()
+        return frame_id
+
+    def get_buffer(self, shape):
+        import torch
+
+        if shape not in self.buffers:
+            self.buffers[shape] = 0
+            self.free[shape] = Queue()
+        if self.free[shape].empty() and self.buffers[shape] < self.num_buffers:
+            self.buffers[shape] += 1
+            return torch.empty(
+                (self.batch_size, *shape),
+                dtype=torch.uint8,
+                pin_memory=self.device.type == "cuda",
+            )
+        buffer, copied = self.get(self.free[shape])
+        if copied is not None:
+            # the previous batch in this buffer must have left it
+            copied.synchronize()
+        return buffer
+
+    def collate(self, pending, shape):
+        items = pending.pop(shape)
+        buffer = self.get_buffer(shape)
+        array = buffer.numpy()
+        with metrics.timer("detect.collate"):
+            for i, (_, _, frame) in enumerate(items):
+                np.copyto(array[i], frame[..., ::-1])  # bgr to rgb
+        self.batches.put((shape, buffer, [(cut, frame_id) for cut, frame_id, _ in items]))
+
+    def pack(self):
+        """
+        Packs the frames of the readers into batches. The end of a cut is
+        passed on as (None, cut, num_frames), None ends the batches.
+        """
+        pending = {}  # shape -> [(cut, frame_id, frame)]
+        ended = set()
+        running = len(self.readers)
+        try:
+            while running > 0 or pending:
+                item = self.get(self.queue) if running > 0 else None
+                metrics.gauge("detect.load_queue", self.queue.qsize())
+                if item is None:
+                    running -= running > 0
+                    if running > 0:
+                        continue
+                    # all readers are done, flush the partial batches
+                    ready = list(pending)
+                else:
+                    cut, frame_id, frame = item
+                    if frame is None:
+                        ended.add(cut)
+                        self.batches.put((None, cut, frame_id))
+                        # partial batches can not grow if all of their cuts have ended
+                        ready = [
+                            shape
+                            for shape, items in pending.items()
+                            if all(cut in ended for cut, _, _ in items)
+                        ]
+                    else:
+                        pending.setdefault(frame.shape, []).append(item)
+                        full = len(pending[frame.shape]) == self.batch_size
+                        ready = [frame.shape] if full else []
+                for shape in ready:
+                    self.collate(pending, shape)
+        except Stopped:
+            pass
+        finally:
+            self.batches.put(None)
+
+    def __iter__(self):
+        """
+        Yields float32 (b c h w) batches on the device with their (cut, frame_id).
+        Cuts whose every frame has been yielded and consumed are moved to self.finished.
+        """
+        while True:
+            item = self.batches.get()
+            if item is None:
+                break
+            shape, buffer, items = item
+            if shape is None:
+                cut, num_frames = buffer, items
+                cut.num_frames = num_frames
+                if cut.finished:
+                    self.finished.append(cut)
+                continue
+            images = buffer[: len(items)].to(self.device, non_blocking=True)
+            copied = None
+            if images.is_cuda:
+                import torch
+
+                copied = torch.cuda.Event()
+                copied.record()
+            images = images.permute(0, 3, 1, 2).float().div_(255.0)
+            # on the cpu, images no longer share the buffer once converted to float
+            self.free[shape].put((buffer, copied))
+            yield images, items
+            for cut, _ in items:
+                cut.processed += 1
+                if cut.finished:
+                    self.finished.append(cut)
+
+    def pop_finished(self):
+        finished = self.finished
+        self.finished = []
+        return finished
+
+
+class ImageWriter:
+    """
+    Encodes and writes images on a pool of threads, so that the next batch can
+    be detected while the crops of the current one are being written. A failed
+    write is recorded as the error of its cut, which is then not saved.
+    """
+
+    def __init__(self, workers, maxsize):
+        self.queue = Queue(maxsize)
+        self.lock = threading.Lock()
+        # notified whenever the pending crops of a cut drop
+        self.written_cond = threading.Condition(self.lock)
+        self.write_time = 0.0
+        self.written = 0
+        self.threads = [
+            threading.Thread(target=self.run, daemon=True) for _ in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, cut, frame_id, image):
+        """Writes image with the frame writer of cut"""
+        with self.lock:
+            cut.pending += 1
+        self.queue.put((cut, frame_id, image))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            cut, frame_id, image = item
+            start = time.perf_counter()
+            try:
+                with metrics.timer("detect.write"):
+                    cut.frames.write(frame_id, image)
+            except Exception as e:
+                with self.lock:
+                    if cut.error is None:
+                        cut.error = e
+            finally:
+                with self.lock:
+                    self.write_time += time.perf_counter() - start
+                    self.written += 1
+                    cut.pending -= 1
+                    self.written_cond.notify_all()
+                self.queue.task_done()
+
+    def wait(self, cut):
+        """Waits until the queued images of cut are written, not those of other cuts"""
+        with self.written_cond:
+            self.written_cond.wait_for(lambda: cut.pending == 0)
+
+    def join(self):
+        """Waits until every queued image is written"""
+        self.queue.join()
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+def detect(model, mp4s, args, writer, manifest, position=0):
+    config = detector_config(args)
+    cuts = []
+    for mp4 in mp4s:
+        if not needs_detection(mp4, config):
+            # already detected with this config, or by another running process
+            continue
+        speaker = mp4.relative_to(args.root).parts[0]
+        cuts.append(Cut(mp4, speaker, args.lease_ttl, config))
+
+    data_loader = VideoFrameLoader(
+        cuts,
+        args.batch_size,
+        args.device,
+        args.concurrent_cuts,
+        frame_format=args.frame_format,
+    )
+
+    timings = dict(load=0.0, infer=0.0)
+    pbar = tqdm.tqdm(total=len(cuts), position=position, desc="Detecting")
+    start = checkpointed = time.perf_counter()
+    try:
+        for images, items in metrics.timed("detect.load", data_loader):
+            timings["load"] += time.perf_counter() - start
+            start = time.perf_counter()
+            with metrics.timer("detect.infer"):
+                bbox_lists, patch_iters = model.detect(images, args.scale_factor)
+            metrics.count("detect.frames", len(items))
+            metrics.gauge("detect.write_queue", writer.queue.qsize())
+            for (cut, frame_id), bbox_list, patch_iter in zip(
+                items, bbox_lists, patch_iters
+            ):
+                try:
+                    face = next(patch_iter)
+                    bbox = next(bbox_list.iterrows())[1]
+                    bbox = compute_relative_bbox(bbox, cut.frame_size, cut.speaker)
+                    bbox["frame_id"] = frame_id
+                    cut.bboxes.append(bbox)
+                    face = face * 255.0
+                    face = face.permute(1, 2, 0).cpu().numpy()
+                    face = face[..., [2, 1, 0]]  # rgb to bgr
+                    writer.put(cut, frame_id, face)
+                except StopIteration:
+                    pass
+                cut.next_frame = frame_id + 1
+                cut.lease.refresh()
+            timings["infer"] += time.perf_counter() - start
+            pbar.set_postfix(
+                load=f"{timings['load']:.1f}s",
+                infer=f"{timings['infer']:.1f}s",
+                write=f"{writer.write_time:.1f}s",
+                load_queue=data_loader.queue.qsize(),
+                write_queue=writer.queue.qsize(),
+            )
+            for cut in data_loader.pop_finished():
+                finish(cut, writer, manifest)
+                pbar.update()
+            if time.perf_counter() - checkpointed > args.checkpoint_interval:
+                with metrics.timer("detect.checkpoint"):
+                    checkpoint(cuts, writer)
+                checkpointed = time.perf_counter()
+            start = time.perf_counter()
+        for cut in data_loader.pop_finished():
+            finish(cut, writer, manifest)
+            pbar.update()
+    finally:
+        data_loader.close()
+        pbar.close()
+        # e.g. the model failed, the unfinished cuts resume from their last checkpoint
+        writer.join()
+        for cut in cuts:
+            if cut.claimed:
+                cut.lease.release()
+
+
+def checkpoint(cuts, writer):
+    """Checkpoints the cuts being detected"""
+    writer.join()
+    for cut in cuts:
+        # a cut with a failed write resumes from its previous checkpoint
+        if cut.claimed and cut.processed > 0 and cut.error is None:
+            if not cut.finished:
+                cut.checkpoint()
+
+
+def finish(cut, writer, manifest):
+    if not cut.claimed:
+        return
+    try:
+        # detection.csv marks the cut as done, all crops must be on disk before it
+        with metrics.timer("detect.wait_write"):
+            writer.wait(cut)
+        if cut.error is not None:
+            # left unmarked, the next run resumes from the last checkpoint
+            print(f"==> ERROR: Failed to detect {cut.mp4}: {cut.error}")
+            if cut.frames is not None:
+                cut.frames.close()
+            return
+        save_detection(cut)
+        manifest.mark(cut.mp4, "detected", config=config_hash(cut.config))
+    finally:
+        cut.lease.release()
+
+
+def save_detection(cut):
+    """Commits the crops and detections of a cut, once all of its crops are written"""
+    cut.frames.close()
+
+    # an empty csv if nothing is detected
+    df = read_bboxes(cut.partial_dir / PARTIAL_CSV)
+    if cut.bboxes:
+        df = pd.concat([df, bbox_frame(cut.bboxes)], ignore_index=True)
 
     df.to_csv(
-        out_dir(mp4, True) / "detection.csv",
+        cut.partial_dir / "detection.csv",
         index=None,
         float_format="%.4f",
     )
+    metrics.count_file("detect.bytes_written", cut.partial_dir / "detection.csv")
+    for name in [PARTIAL_CSV, CHECKPOINT]:
+        path = cut.partial_dir / name
+        if path.exists():
+            path.unlink()
+    sidecar = cut.state()
+    sidecar.update(hparams=cut.config, num_frames=cut.num_frames)
+    write_state(cut.partial_dir / SIDECAR, sidecar)
+    directory = out_dir(cut.mp4)
+    if directory.exists():
+        # the previous detection stops looking done before any of its crops change
+        for name in ["detection.csv", SIDECAR]:
+            if (directory / name).exists():
+                (directory / name).unlink()
+        if cut.keep == 0:
+            # its crops are replaced, not merged
+            clear_frames(directory)
+    commit(cut.partial_dir, directory, last=[SIDECAR, "detection.csv"])
+
+
+def run(filelist, args, position=0, results=None):
+    """results: the queue a spawned process puts its metrics to"""
+    # torch and the model are only loaded by the processes that detect
+    import torch
+    from efd import s3fd
+
+    if args.device == "cpu" and args.workers > 1:
+        torch.set_num_threads(max(1, os.cpu_count() // args.workers))
+    reporter = None
+    if results is not None:
+        reporter = metrics.start(args, f"worker-{position}")
+    model = s3fd(pretrained=True).to(args.device)
+    writer = ImageWriter(args.writers, args.write_queue)
+    manifest = Manifest(args.root)
+    try:
+        detect(model, filelist, args, writer, manifest, position)
+    finally:
+        writer.close()
+        manifest.close()
+        if reporter is not None:
+            reporter.close(summarize=False)
+        if results is not None:
+            results.put(metrics.collect())
 
 
 def main():
@@ -170,27 +713,107 @@ def main():
         "--device",
         default="cuda",
     )
+    parser.add_argument(
+        "--concurrent_cuts",
+        help="Number of cuts decoded at the same time to fill the batches",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of detection processes, each with its own model",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--lease_ttl",
+        help="Seconds after which the claim of a crashed process on a cut expires",
+        default=600,
+        type=float,
+    )
+    parser.add_argument(
+        "--frame_format",
+        help="Write face crops as one jpg per frame, or one archive per cut",
+        choices=FRAME_FORMATS,
+        default="jpg",
+    )
+    parser.add_argument(
+        "--checkpoint_interval",
+        help="Seconds between two checkpoints of the cuts being detected",
+        default=60,
+        type=float,
+    )
+    parser.add_argument(
+        "--writers",
+        help="Number of threads encoding and writing the face crops",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--write_queue",
+        help="Maximum number of crops waiting to be written",
+        default=256,
+        type=int,
+    )
+    metrics.add_metrics_arguments(parser)
 
     args = parser.parse_args()
-    model = s3fd(pretrained=True).to(args.device)
 
+    config = detector_config(args)
+    digest = config_hash(config)
+    manifest = Manifest(args.root)
     filelist = []
     for speaker, split in product(args.speakers, args.splits):
-        filelist.extend(
-            get_filelist(
-                args.root,
-                speaker,
-                split,
-                "intervals/{youtube_id}/**/*.mp4",
-            )
-        )
-    filelist = [p for p in filelist if not (out_dir(p) / "detection.csv").exists()]
-
-    # shuffle the list to allow concurrent processes running in different order
+        manifest.update(speaker, split)
+        filelist.extend(manifest.intervals(speaker, split, "detected", done=False))
+        # only the sidecars of the intervals not recorded with this config are read
+        current, removed = [], []
+        stale = manifest.intervals(speaker, split, "detected", done=True, config=digest)
+        for mp4 in stale:
+            if not (out_dir(mp4) / "detection.csv").exists():
+                # the detections were deleted
+                removed.append(mp4)
+            elif not needs_detection(mp4, config):
+                current.append(mp4)
+                continue
+            # detected with another config, or before the interval has changed
+            if mp4.exists():
+                filelist.append(mp4)
+        manifest.mark_all(removed, "detected", done=False)
+        manifest.mark_all(current, "detected", config=digest)
+    manifest.close()
+
+    # shuffle the list so that concurrent processes rarely contend for the same lease
     np.random.shuffle(filelist)
 
-    for mp4 in tqdm.tqdm(filelist):
-        detect(model, mp4, args)
+    reporter = metrics.start(args)
+    if args.workers > 1:
+        context = mp.get_context("spawn")
+        results = context.Queue()
+        processes = [
+            context.Process(
+                target=run, args=(filelist[i :: args.workers], args, i, results)
+            )
+            for i in range(args.workers)
+        ]
+        for process in processes:
+            process.start()
+        # drained before joining, a process exits only once its metrics are read
+        remaining = len(processes)
+        while remaining > 0:
+            try:
+                metrics.merge(results.get(timeout=1))
+                remaining -= 1
+            except Empty:
+                # a crashed process never puts its metrics
+                if not any(process.is_alive() for process in processes):
+                    break
+        for process in processes:
+            process.join()
+    else:
+        run(filelist, args)
+    if reporter is not None:
+        reporter.close()
 
 
 if __name__ == "__main__":
@@ -1,50 +1,198 @@
-import pkg_resources
 import shutil
 import numpy as np
-import soundfile
-import librosa
 import os
 import tqdm
+import json
+import time
+import shlex
+import threading
+import argparse
 import subprocess
-import sys
+from concurrent.futures import ThreadPoolExecutor
 from itertools import product
 from pathlib import Path
 
-from .utils import working_directory, create_parser
+from .utils import working_directory, create_parser, atomic_path
+
+
+DOWNLOADER = "youtube-dl -f best -o {output}.%(ext)s -- {youtube_id}"
 
 
 def get_todo_list(split):
     video_dir = Path("videos")
-    done = set([path.stem for path in video_dir.glob("*.mp4")])
+    # hidden files are downloads in progress
+    done = set(
+        path.stem for path in video_dir.glob("*.mp4") if not path.name.startswith(".")
+    )
     with open(f"{split}.txt", "r") as f:
         target = set(f.read().strip().splitlines())
     todo = target - done
     return list(todo)
 
 
-def download(todo):
+class DownloadState:
+    """
+    Per-id attempts and last error, kept in download.json so that ids which
+    keep failing (e.g. removed videos) are not retried on every run.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        if self.path.exists():
+            self.state = json.loads(self.path.read_text())
+        else:
+            self.state = {}
+
+    def failures(self, youtube_id):
+        return self.state.get(youtube_id, {}).get("failures", 0)
+
+    def update(self, youtube_id, error=None):
+        with self.lock:
+            if error is None:
+                self.state.pop(youtube_id, None)
+            else:
+                entry = self.state.setdefault(youtube_id, dict(failures=0))
+                entry["failures"] += 1
+                entry["error"] = str(error)
+                entry["time"] = time.time()
+            with atomic_path(self.path) as tmp:
+                tmp.write_text(json.dumps(self.state, indent=2, sort_keys=True))
+
+
+def download_one(youtube_id, video_dir, args):
+    """
+    Downloads a video to a hidden name, which is renamed to {video_dir}/{id}.{ext}
+    once complete. The hidden name is the same across runs so that the
+    downloader can resume a partial file.
+
+    Returns the path and the size in bytes of the video.
+    """
+    if args.retries < 1:
+        raise ValueError(f"Expect at least one attempt, got {args.retries}.")
+    output = video_dir / f".{youtube_id}.download"
+    # split before formatting, so that paths with spaces stay one argument
+    command = [
+        token.format(output=output, youtube_id=youtube_id)
+        for token in shlex.split(args.downloader)
+    ]
+    for attempt in range(args.retries):
+        if attempt > 0:
+            time.sleep(args.backoff * 2 ** (attempt - 1))
+        result = subprocess.run(
+            command,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        if result.returncode == 0:
+            break
+    else:
+        error = result.stderr.decode(errors="replace").strip().splitlines()
+        raise RuntimeError(error[-1] if error else f"exit code {result.returncode}")
+    outputs = [
+        path
+        for path in video_dir.glob(f"{output.name}.*")
+        if path.suffix not in [".part", ".ytdl"]
+    ]
+    if len(outputs) != 1:
+        raise RuntimeError(f"Expect one output, got {[p.name for p in outputs]}.")
+    path = video_dir / (youtube_id + outputs[0].suffix)
+    size = outputs[0].stat().st_size
+    os.replace(outputs[0], path)
+    return path, size
+
+
+def download(todo, args):
+    """
+    Downloads the ids on a thread pool, one downloader process per id.
+    """
     video_dir = Path("videos")
     video_dir.mkdir(exist_ok=True)
-    with open("todo.txt", "w") as f:
-        f.write("\n".join(sorted(todo)))
-    args = ["youtube-dl", "-f", "best", "-a", "todo.txt", "-o", "videos/%(id)s.%(ext)s"]
-    try:
-        subprocess.check_call(args)
-        os.remove("todo.txt")
-    except Exception as e:
-        print(e)
+    state = DownloadState("download.json")
+
+    if args.max_failures > 0:
+        skipped = [i for i in todo if state.failures(i) >= args.max_failures]
+        if skipped:
+            print(
+                f"==> Skipped {len(skipped)} ids that failed {args.max_failures} times, "
+                "see download.json."
+            )
+        todo = [i for i in todo if i not in skipped]
+
+    def job(youtube_id):
+        try:
+            _, size = download_one(youtube_id, video_dir, args)
+        except Exception as e:
+            state.update(youtube_id, e)
+            return youtube_id, 0, e
+        state.update(youtube_id)
+        return youtube_id, size, None
+
+    start = time.time()
+    total = 0
+    failed = 0
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        results = executor.map(job, todo)
+        for youtube_id, size, error in tqdm.tqdm(results, total=len(todo)):
+            if error is not None:
+                print(f"==> ERROR: Failed to download {youtube_id}: {error}")
+                failed += 1
+            total += size
+    elapsed = time.time() - start
+    print(
+        f"==> Downloaded {len(todo) - failed}/{len(todo)} videos, "
+        f"{total / 2 ** 20:.1f} MB in {elapsed:.0f} s "
+        f"({total / 2 ** 20 / max(elapsed, 1e-6):.2f} MB/s)."
+    )
+
+
+def attempts(value):
+    """An argparse type for the number of attempts, at least one"""
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"expect at least 1 attempt, got {value}")
+    return value
 
 
 def create_datalist(root, speaker, split):
     tgt = (root / speaker / split).with_suffix(".txt")
     if not tgt.exists():
         tgt.parent.mkdir(parents=True, exist_ok=True)
-        src = pkg_resources.resource_filename(__name__, f"data/{speaker}/{split}.txt")
+        src = Path(__file__).parent / "data" / speaker / f"{split}.txt"
         shutil.copy(src, tgt)
 
 
 def main():
     parser = create_parser()
+    parser.add_argument(
+        "--concurrency",
+        help="Number of videos downloaded at the same time",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--retries",
+        help="Attempts per video, with exponential backoff in between",
+        type=attempts,
+        default=3,
+    )
+    parser.add_argument(
+        "--backoff",
+        help="Seconds to wait before the first retry, doubled for each further one",
+        type=float,
+        default=10,
+    )
+    parser.add_argument(
+        "--max_failures",
+        help="Skip videos that failed in this many previous runs (0 to never skip)",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        "--downloader",
+        help="Command downloading {youtube_id} to {output}.<ext>",
+        default=DOWNLOADER,
+    )
     args = parser.parse_args()
 
     pairs = sorted(product(args.speakers, args.splits))
@@ -58,7 +206,7 @@ def main():
             if todo:
                 print(f"==> Downloading {speaker}/{split} ...")
                 np.random.shuffle(todo)
-                download(todo)
+                download(todo, args)
             else:
                 print(f"==> {speaker}/{split} is completed.")
 
@@ -0,0 +1,220 @@
+import io
+import json
+import tarfile
+import tqdm
+import numpy as np
+from itertools import groupby, product
+from pathlib import Path
+from scipy.io import wavfile
+
+from .archive import open_frames
+from .manifest import Manifest
+from .storage import load_specs, read_sidecar
+from .utils import commit, create_parser, out_dir, temp_path
+
+
+def to_npy(array):
+    f = io.BytesIO()
+    np.save(f, array)
+    return f.getvalue()
+
+
+def from_npy(data):
+    return np.load(io.BytesIO(data))
+
+
+def mel_hparams(directory, args):
+    """
+    The sample rate and hop size the spectrograms of a cut were computed with,
+    read from their sidecar. The values given in args must match them, and are
+    taken for the spectrograms saved before sidecars existed.
+    """
+    sidecar = read_sidecar(directory)
+    if sidecar is None:
+        return args.sample_rate or 16000, args.hop_size or 200
+    hparams = sidecar["hparams"]
+    for name in ["sample_rate", "hop_size"]:
+        expected = getattr(args, name)
+        if expected is not None and hparams[name] != expected:
+            raise ValueError(
+                f"The spectrograms of {directory} were computed with "
+                f"{name}={hparams[name]}, got {expected}."
+            )
+    return hparams["sample_rate"], hparams["hop_size"]
+
+
+def iter_windows(mp4, info, args):
+    """
+    Yields (key, members) of every window of the cut whose frames all have a face.
+    """
+    if info is None or not info["fps"] > 0:
+        print(f"==> WARNING: Unknown fps of {mp4}, skipped.")
+        return
+    directory = out_dir(mp4)
+    frames = open_frames(directory)
+    sample_rate, wav = wavfile.read(directory / "audio.wav")
+    mels = load_specs(directory)
+    if mels is not None:
+        mel_rate, hop_size = mel_hparams(directory, args)
+    fps = info["fps"]
+    num_frames = round(args.window * fps)
+    stride = round(args.stride * fps)
+    last = int(len(wav) / sample_rate * fps) - num_frames
+    for start in range(0, last + 1, stride):
+        frame_ids = range(start, start + num_frames)
+        if not all(frame_id in frames for frame_id in frame_ids):
+            continue
+        begin = start / fps
+        key = f"{mp4.parent.name}_{mp4.stem}_{start:05d}"
+        members = [
+            (f"{i:03d}.jpg", frames[frame_id].tobytes())
+            for i, frame_id in enumerate(frame_ids)
+        ]
+        samples = round(args.window * sample_rate)
+        offset = round(begin * sample_rate)
+        members.append(("wav.npy", to_npy(wav[offset : offset + samples])))
+        if mels is not None:
+            steps = round(args.window * mel_rate / hop_size)
+            offset = round(begin * mel_rate / hop_size)
+            for name, spec in [("mel", mels["spec"]), ("linear", mels["lspec"])]:
+                window = np.asarray(spec[:, offset : offset + steps], np.float32)
+                members.append((f"{name}.npy", to_npy(window)))
+        meta = dict(
+            youtube_id=mp4.parent.name,
+            cut=int(mp4.stem.split("-")[-1]),
+            start_frame=start,
+            fps=fps,
+            sample_rate=sample_rate,
+        )
+        members.append(("json", json.dumps(meta).encode()))
+        yield key, members
+
+
+class ShardWriter:
+    """
+    Writes samples into tar shards of about max_size bytes, the members of a
+    sample are stored next to each other so shards can be read sequentially.
+    A shard is written to a temporary name and renamed once closed.
+    """
+
+    def __init__(self, pattern, max_size):
+        self.pattern = pattern
+        self.max_size = max_size
+        self.index = -1
+        self.tar = None
+        self.tmp = None
+        self.paths = []
+
+    def open_next(self):
+        self.close()
+        self.index += 1
+        path = Path(self.pattern.format(self.index))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.tmp = temp_path(path)
+        self.tar = tarfile.open(self.tmp, "w")
+        self.paths.append(path)
+
+    def write(self, key, members):
+        if self.tar is None or self.tar.fileobj.tell() >= self.max_size:
+            self.open_next()
+        for name, data in members:
+            info = tarfile.TarInfo(f"{key}.{name}")
+            info.size = len(data)
+            self.tar.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        if self.tar is not None:
+            self.tar.close()
+            commit(self.tmp, self.paths[-1])
+            self.tar = self.tmp = None
+
+    def abort(self):
+        """Removes the shard being written"""
+        if self.tar is not None:
+            self.tar.close()
+            self.tmp.unlink()
+            self.paths.pop()
+            self.tar = self.tmp = None
+
+
+def iter_shards(paths):
+    """
+    Streams the samples of the shards as dicts, without any filesystem lookup per sample.
+    """
+    for path in paths:
+        with tarfile.open(path, "r|") as tar:
+            members = ((member, tar.extractfile(member).read()) for member in tar)
+            for key, group in groupby(members, lambda m: m[0].name.split(".", 1)[0]):
+                sample = dict(key=key, frames=[])
+                for member, data in group:
+                    name = member.name.split(".", 1)[1]
+                    if name.endswith(".jpg"):
+                        sample["frames"].append(np.frombuffer(data, np.uint8))
+                    elif name == "json":
+                        sample.update(json.loads(data))
+                    else:
+                        sample[name[: -len(".npy")]] = from_npy(data)
+                yield sample
+
+
+def main():
+    parser = create_parser()
+    parser.add_argument("--out", type=Path, default="shards")
+    parser.add_argument(
+        "--window",
+        help="Length of a sample in seconds",
+        default=3.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--stride",
+        help="Seconds between the starts of two samples",
+        default=3.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--shard_size",
+        help="Approximate size of a shard in MB",
+        default=1024,
+        type=float,
+    )
+    parser.add_argument(
+        "--sample_rate",
+        help="Expected sample rate of the spectrograms, read from their sidecar "
+        "(default 16000 for spectrograms saved without one)",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--hop_size",
+        help="Expected hop size of the spectrograms, read from their sidecar "
+        "(default 200 for spectrograms saved without one)",
+        type=int,
+        default=None,
+    )
+    args = parser.parse_args()
+
+    manifest = Manifest(args.root)
+    for speaker, split in product(args.speakers, args.splits):
+        manifest.update(speaker, split)
+        mp4s = manifest.intervals(speaker, split, "prepared", done=True)
+        if not mp4s:
+            print(f"==> No prepared interval is found for {speaker}/{split}, skipped.")
+            continue
+        writer = ShardWriter(
+            str(args.out / f"{speaker}-{split}-{{:05d}}.tar"),
+            args.shard_size * 2 ** 20,
+        )
+        try:
+            for mp4 in tqdm.tqdm(mp4s, desc=f"Exporting {speaker}/{split}"):
+                for key, members in iter_windows(mp4, manifest.info(mp4), args):
+                    writer.write(key, members)
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+    manifest.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .media import probe
+from .utils import atomic_path, out_dir, read_split
+
+# stage -> file under the output directory of an interval that marks it as done
+STAGES = {
+    "detected": "detection.csv",
+    "prepared": "audio.wav",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS intervals (
+    path TEXT PRIMARY KEY,
+    speaker TEXT,
+    youtube_id TEXT,
+    cut INTEGER,
+    duration REAL,
+    fps REAL,
+    width INTEGER,
+    height INTEGER,
+    constant_fps INTEGER DEFAULT 0,
+    detected INTEGER DEFAULT 0,
+    prepared INTEGER DEFAULT 0,
+    detected_config TEXT,
+    prepared_config TEXT
+);
+CREATE INDEX IF NOT EXISTS intervals_video ON intervals (speaker, youtube_id);
+CREATE TABLE IF NOT EXISTS collected (
+    output TEXT,
+    path TEXT,
+    mtime REAL,
+    PRIMARY KEY (output, path)
+);
+CREATE TABLE IF NOT EXISTS probes (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    duration REAL,
+    fps REAL,
+    width INTEGER,
+    height INTEGER
+);
+"""
+
+
+def manifest_path(root):
+    return Path(root, f"manifest-{socket.gethostname()}.sqlite")
+
+
+def probed(info):
+    """The probed columns of an interval"""
+    return (
+        *(info["duration"], info["fps"], info["width"], info["height"]),
+        int(info["constant_fps"]),
+    )
+
+
+class Manifest:
+    """
+    A persistent index of the intervals under root, with their duration,
+    resolution and the completion state of each stage. Only the interval
+    directories whose mtime has changed are rescanned on update.
+
+    Paths are stored relative to root.
+
+    Each host keeps its own manifest, as SQLite locking is not reliable over
+    network filesystems. The manifest only caches the state of the files
+    under root, what other hosts have done is found on the filesystem.
+    """
+
+    def __init__(self, root, workers=16):
+        self.root = Path(root)
+        self.workers = workers
+        self.root.mkdir(parents=True, exist_ok=True)
+        path = manifest_path(self.root)
+        shared = self.root / "manifest.sqlite"
+        if not path.exists() and shared.exists():
+            # start from the manifest of the runs before it was kept per host
+            with atomic_path(path) as tmp:
+                shutil.copyfile(shared, tmp)
+        self.db = sqlite3.connect(str(path), timeout=60)
+        self.db.executescript(SCHEMA)
+        self.migrate()
+
+    def migrate(self):
+        """Adds the columns of intervals to a manifest created before them"""
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(intervals)")}
+        added = [f"{stage}_config TEXT" for stage in STAGES]
+        # intervals probed before are not known to be seekable until probed again
+        added.append("constant_fps INTEGER DEFAULT 0")
+        for column in added:
+            if column.split()[0] in columns:
+                continue
+            try:
+                with self.db:
+                    self.db.execute(f"ALTER TABLE intervals ADD COLUMN {column}")
+            except sqlite3.OperationalError:
+                # added by a concurrent process meanwhile
+                pass
+
+    def update(self, speaker, split):
+        stale = []
+        for youtube_id in read_split(self.root, speaker, split):
+            dirpath = Path(speaker, "intervals", youtube_id)
+            try:
+                mtime = (self.root / dirpath).stat().st_mtime
+            except FileNotFoundError:
+                mtime = None
+            row = self.db.execute(
+                "SELECT mtime FROM dirs WHERE path = ?", (str(dirpath),)
+            ).fetchone()
+            if (row and row[0]) != mtime:
+                stale.append((dirpath, youtube_id, mtime))
+        if not stale:
+            return
+
+        jobs = []
+        removed = []
+        changed = []
+        for dirpath, youtube_id, mtime in stale:
+            known = {
+                path: detected or prepared
+                for path, detected, prepared in self.db.execute(
+                    "SELECT path, detected, prepared FROM intervals "
+                    "WHERE speaker = ? AND youtube_id = ?",
+                    (speaker, youtube_id),
+                )
+            }
+            found = set()
+            if mtime is not None:
+                for entry in os.scandir(self.root / dirpath):
+                    if entry.name.startswith("cut-") and entry.name.endswith(".mp4"):
+                        found.add(str(dirpath / entry.name))
+            # intervals deleted after a stage are kept so that their outputs are still listed
+            removed.extend(
+                (path,) for path, done in known.items() if path not in found and not done
+            )
+            jobs.extend((path, youtube_id) for path in found if path not in known)
+            # the intervals may have been cut again, they are probed and their
+            # outputs are checked once more
+            changed.extend(path for path in found if path in known)
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            infos = list(executor.map(self.probe, [path for path, _ in jobs] + changed))
+        infos, changed_infos = infos[: len(jobs)], infos[len(jobs) :]
+
+        rows = []
+        for (path, youtube_id), info in zip(jobs, infos):
+            cut = int(Path(path).stem.split("-")[-1])
+            done = [
+                (self.root / out_dir(Path(path)) / marker).exists()
+                for marker in STAGES.values()
+            ]
+            rows.append((path, speaker, youtube_id, cut, *probed(info), *done))
+        with self.db:
+            self.db.executemany("DELETE FROM intervals WHERE path = ?", removed)
+            self.db.executemany(
+                "UPDATE intervals SET duration = ?, fps = ?, width = ?, height = ?, "
+                "constant_fps = ?, "
+                + ", ".join(f"{stage}_config = NULL" for stage in STAGES)
+                + " WHERE path = ?",
+                [(*probed(info), path) for path, info in zip(changed, changed_infos)],
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO intervals (path, speaker, youtube_id, cut, "
+                "duration, fps, width, height, constant_fps, detected, prepared) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO dirs VALUES (?, ?)",
+                [(str(dirpath), mtime) for dirpath, _, mtime in stale],
+            )
+
+    def probe(self, path):
+        try:
+            return probe(self.root / path)
+        except (subprocess.CalledProcessError, ValueError, KeyError) as e:
+            print(f"==> WARNING: Failed to probe {path}: {e}")
+            return dict(
+                duration=float("nan"), fps=0.0, width=0, height=0, constant_fps=False
+            )
+
+    def probe_all(self, paths):
+        """
+        Probes many files on a thread pool, caching the results by path, size and mtime.
+        """
+        keys = []
+        for path in paths:
+            path = Path(path)
+            stat = path.stat()
+            keys.append((str(path.relative_to(self.root)), stat.st_size, stat.st_mtime))
+        cached = {}
+        for key in keys:
+            row = self.db.execute(
+                "SELECT duration, fps, width, height FROM probes "
+                "WHERE path = ? AND size = ? AND mtime = ?",
+                key,
+            ).fetchone()
+            if row is not None:
+                cached[key[0]] = dict(zip(["duration", "fps", "width", "height"], row))
+        missing = [key for key in keys if key[0] not in cached]
+        with ThreadPoolExecutor(self.workers) as executor:
+            infos = list(executor.map(lambda key: self.probe(key[0]), missing))
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (*key, info["duration"], info["fps"], info["width"], info["height"])
+                    for key, info in zip(missing, infos)
+                    if info["width"] > 0
+                ],
+            )
+        cached.update((key[0], info) for key, info in zip(missing, infos))
+        return [cached[key[0]] for key in keys]
+
+    def intervals(self, speaker, split, stage=None, done=None, config=None):
+        """
+        Lists the mp4s of a speaker/split, optionally only those whose stage is (not) done.
+
+        Intervals not done yet are checked against the filesystem, as another
+        process may have finished them. With config, only the done intervals
+        whose stage is not recorded as done with that config hash are listed.
+        """
+        youtube_ids = set(read_split(self.root, speaker, split))
+        columns = "path, youtube_id" + (f", {stage}, {stage}_config" if stage else "")
+        rows = self.db.execute(
+            f"SELECT {columns} FROM intervals WHERE speaker = ? ORDER BY path",
+            (speaker,),
+        ).fetchall()
+        paths = []
+        finished = []
+        for row in rows:
+            if row[1] not in youtube_ids:
+                continue
+            path = Path(row[0])
+            if stage is not None:
+                state = bool(row[2])
+                if not state and (self.root / out_dir(path) / STAGES[stage]).exists():
+                    finished.append(path)
+                    state = True
+                if done is not None and state != done:
+                    continue
+                if config is not None and (not state or row[3] == config):
+                    continue
+            paths.append(self.root / path)
+        if finished:
+            with self.db:
+                self.db.executemany(
+                    f"UPDATE intervals SET {stage} = 1 WHERE path = ?",
+                    [(str(path),) for path in finished],
+                )
+        return paths
+
+    def info(self, mp4):
+        columns = ["duration", "fps", "width", "height", "constant_fps"]
+        row = self.db.execute(
+            f"SELECT {', '.join(columns)} FROM intervals WHERE path = ?",
+            (str(Path(mp4).relative_to(self.root)),),
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(columns, row))
+
+    def resolutions(self, speaker, youtube_ids):
+        """
+        Returns {youtube_id: (width, height)} from the probed intervals, which are
+        stream copies of the raw videos and have their resolution.
+        """
+        rows = self.db.execute(
+            "SELECT youtube_id, width, height FROM intervals "
+            "WHERE speaker = ? AND width > 0",
+            (speaker,),
+        )
+        youtube_ids = set(youtube_ids)
+        return {
+            youtube_id: (width, height)
+            for youtube_id, width, height in rows
+            if youtube_id in youtube_ids
+        }
+
+    def mark(self, mp4, stage, done=True, config=None):
+        """config: the hash of the config the stage is done with"""
+        self.mark_all([mp4], stage, done, config)
+
+    def mark_all(self, mp4s, stage, done=True, config=None):
+        assert stage in STAGES
+        config = config if done else None
+        with self.db:
+            self.db.executemany(
+                f"UPDATE intervals SET {stage} = ?, {stage}_config = ? WHERE path = ?",
+                [
+                    (int(done), config, str(Path(mp4).relative_to(self.root)))
+                    for mp4 in mp4s
+                ],
+            )
+
+    def collected(self, output):
+        """Returns {path: mtime} of the files merged into output by the last collect"""
+        return dict(
+            self.db.execute(
+                "SELECT path, mtime FROM collected WHERE output = ?", (str(output),)
+            )
+        )
+
+    def set_collected(self, output, mtimes):
+        with self.db:
+            self.db.execute("DELETE FROM collected WHERE output = ?", (str(output),))
+            self.db.executemany(
+                "INSERT INTO collected VALUES (?, ?, ?)",
+                [(str(output), path, mtime) for path, mtime in mtimes.items()],
+            )
+
+    def close(self):
+        self.db.close()
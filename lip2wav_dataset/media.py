@@ -0,0 +1,194 @@
+import os
+import json
+import functools
+import struct
+import subprocess
+import threading
+import numpy as np
+
+
+def ffmpeg_audio_options(speaker, sample_rate):
+    """
+    The per-speaker ffmpeg options used to extract audio as (input options, output options).
+    """
+    if speaker in ["hs", "eh", "dl"]:
+        return (
+            ["-hide_banner", "-loglevel", "panic", "-threads", "1"],
+            [
+                *("-async", "1", "-ac", "1", "-vn"),
+                *("-acodec", "pcm_s16le", "-ar", "16000", "-f", "wav"),
+            ],
+        )
+    return (["-loglevel", "panic"], ["-ar", str(sample_rate), "-f", "wav"])
+
+
+def ffmpeg_audio_command(mp4, speaker, sample_rate, output="pipe:1"):
+    """
+    The per-speaker ffmpeg command used to extract audio, writing a wav to output.
+    """
+    input_options, output_options = ffmpeg_audio_options(speaker, sample_rate)
+    return ["ffmpeg", *input_options, "-y", "-i", str(mp4), *output_options, output]
+
+
+def read_wav_stream(data):
+    """Parse a wav written by ffmpeg to a pipe.
+
+    ffmpeg cannot seek back on a pipe to fill in the RIFF and data chunk sizes,
+    they are patched here so that the bytes equal what ffmpeg writes to a file.
+
+    Returns:
+        data: the patched wav bytes
+        sample_rate: int
+        pcm: int16 samples of shape (n c), a view of data
+    """
+    data = bytearray(data)
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise ValueError("Not a wav stream.")
+    channels = sample_rate = None
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id = bytes(data[offset : offset + 4])
+        (size,) = struct.unpack_from("<I", data, offset + 4)
+        if chunk_id == b"fmt ":
+            tag, channels, sample_rate = struct.unpack_from("<HHI", data, offset + 8)
+            (bits,) = struct.unpack_from("<H", data, offset + 22)
+            if tag != 1 or bits != 16:
+                raise ValueError(f"Expect 16-bit pcm, got format {tag} ({bits} bits).")
+        elif chunk_id == b"data":
+            if channels is None:
+                raise ValueError("Missing fmt chunk before data.")
+            start = offset + 8
+            struct.pack_into("<I", data, offset + 4, len(data) - start)
+            struct.pack_into("<I", data, 4, len(data) - 8)
+            count = (len(data) - start) // (2 * channels) * channels
+            pcm = np.frombuffer(data, "<i2", count, start).reshape(-1, channels)
+            return data, sample_rate, pcm
+        offset += 8 + size + (size & 1)
+    raise ValueError("Missing data chunk.")
+
+
+def decode_audio(mp4, speaker, sample_rate):
+    command = ffmpeg_audio_command(mp4, speaker, sample_rate)
+    output = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+    return read_wav_stream(output)
+
+
+@functools.lru_cache()
+def passthrough_options():
+    """
+    Output options keeping every decoded frame as is, without duplicating or
+    dropping frames of variable frame rate videos. -fps_mode replaces -vsync
+    from ffmpeg 5.1 on.
+    """
+    output = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-h", "long"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    ).stdout
+    if b"-fps_mode" in output:
+        return ["-fps_mode", "passthrough"]
+    return ["-vsync", "passthrough"]
+
+
+def probe(path):
+    """
+    Reads duration, fps and resolution from the container headers, without decoding.
+    The frame rate is constant when the base rate equals the average rate.
+    """
+    command = [
+        *("ffprobe", "-v", "error", "-select_streams", "v:0"),
+        *(
+            "-show_entries",
+            "stream=width,height,r_frame_rate,avg_frame_rate:format=duration",
+        ),
+        *("-of", "json", str(path)),
+    ]
+    info = json.loads(subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout)
+    stream = info["streams"][0] if info.get("streams") else {}
+    fps = frame_rate(stream.get("avg_frame_rate"))
+    return dict(
+        duration=float(info.get("format", {}).get("duration", "nan")),
+        fps=fps,
+        width=int(stream.get("width", 0)),
+        height=int(stream.get("height", 0)),
+        constant_fps=fps > 0 and frame_rate(stream.get("r_frame_rate")) == fps,
+    )
+
+
+def frame_rate(rate):
+    """Parses an ffprobe rate such as 30000/1001, 0 when unknown"""
+    numerator, _, denominator = (rate or "0/0").partition("/")
+    denominator = float(denominator or 1)
+    return float(numerator) / denominator if denominator else 0.0
+
+
+class IntervalDecoder:
+    """
+    Demuxes an interval once with a single ffmpeg process: bgr24 frames are
+    streamed through an extra pipe while the wav is collected from stdout.
+
+    Iterate over it for the frames, then call audio() for the wav. close()
+    stops ffmpeg if the frames fail to be processed before that.
+    """
+
+    def __init__(self, mp4, speaker, sample_rate, resolution):
+        width, height = resolution
+        self.frame_shape = (height, width, 3)
+        input_options, output_options = ffmpeg_audio_options(speaker, sample_rate)
+        # the single threaded decoding is meant for the audio, not the frames
+        input_options = ["-threads:a" if o == "-threads" else o for o in input_options]
+        read_fd, write_fd = os.pipe()
+        command = [
+            *("ffmpeg", *input_options, "-y", "-i", str(mp4)),
+            *("-map", "0:v:0", *passthrough_options()),
+            *("-f", "rawvideo", "-pix_fmt", "bgr24"),
+            f"pipe:{write_fd}",
+            *output_options,
+            "pipe:1",
+        ]
+        try:
+            self.proc = subprocess.Popen(
+                command,
+                stdout=subprocess.PIPE,
+                pass_fds=(write_fd,),
+            )
+        finally:
+            os.close(write_fd)
+        self.frames = os.fdopen(read_fd, "rb")
+        self.wav = None
+        # both pipes must be drained together, otherwise ffmpeg blocks on the full one
+        self.reader = threading.Thread(target=self._read_wav, daemon=True)
+        self.reader.start()
+
+    def _read_wav(self):
+        self.wav = self.proc.stdout.read()
+
+    def __iter__(self):
+        size = int(np.prod(self.frame_shape))
+        with self.frames:
+            while True:
+                buf = self.frames.read(size)
+                if len(buf) < size:
+                    break
+                yield np.frombuffer(buf, np.uint8).reshape(self.frame_shape)
+
+    def audio(self):
+        """Returns the same as decode_audio"""
+        if not self.frames.closed:
+            # ffmpeg fails on a closed pipe, drain the frames not iterated over
+            while self.frames.read(1 << 20):
+                pass
+            self.frames.close()
+        self.reader.join()
+        returncode = self.proc.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self.proc.args)
+        return read_wav_stream(self.wav)
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+        self.frames.close()
+        self.reader.join()
+        self.proc.stdout.close()
+        self.proc.wait()
@@ -0,0 +1,236 @@
+"""
+Opt-in instrumentation of the stages: cumulative timers, counters (e.g. bytes
+read and written) and gauges (e.g. queue occupancy). Everything is a no-op
+until enable() is called, which the subcommands do when --metrics is given.
+
+Process pool workers return collect() along with their results, the parent
+merges it so that its report covers the whole run.
+"""
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+from pathlib import Path
+
+from .utils import atomic_path
+
+_enabled = False
+_lock = threading.Lock()
+_timers = {}  # name -> [seconds, count]
+_counters = {}  # name -> value
+_gauges = {}  # name -> [last, max, sum, samples]
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def enabled():
+    return _enabled
+
+
+@contextlib.contextmanager
+def timer(name):
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            entry = _timers.setdefault(name, [0.0, 0])
+            entry[0] += elapsed
+            entry[1] += 1
+
+
+def timed(name, iterable):
+    """Yields from iterable, timing how long each item takes to be produced"""
+    iterator = iter(iterable)
+    while True:
+        with timer(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def count(name, value=1):
+    if _enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + value
+
+
+def count_file(name, path):
+    """Counts the size of a file, only stat'ed when enabled"""
+    if _enabled:
+        count(name, os.stat(path).st_size)
+
+
+def gauge(name, value):
+    if _enabled:
+        with _lock:
+            entry = _gauges.setdefault(name, [0, value, 0, 0])
+            entry[0] = value
+            entry[1] = max(entry[1], value)
+            entry[2] += value
+            entry[3] += 1
+
+
+def snapshot():
+    with _lock:
+        return dict(
+            timers={name: list(entry) for name, entry in _timers.items()},
+            counters=dict(_counters),
+            gauges={name: list(entry) for name, entry in _gauges.items()},
+        )
+
+
+def collect():
+    """Returns the snapshot of this process and resets it, None when disabled"""
+    if not _enabled:
+        return None
+    with _lock:
+        result = dict(
+            timers=dict(_timers), counters=dict(_counters), gauges=dict(_gauges)
+        )
+        _timers.clear()
+        _counters.clear()
+        _gauges.clear()
+    return result
+
+
+def merge(other):
+    """Adds a snapshot of another process"""
+    if other is None:
+        return
+    with _lock:
+        for name, (seconds, n) in other["timers"].items():
+            entry = _timers.setdefault(name, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += n
+        for name, value in other["counters"].items():
+            _counters[name] = _counters.get(name, 0) + value
+        for name, (last, peak, total, samples) in other["gauges"].items():
+            entry = _gauges.setdefault(name, [last, peak, 0, 0])
+            entry[0] = last
+            entry[1] = max(entry[1], peak)
+            entry[2] += total
+            entry[3] += samples
+
+
+def prometheus(state):
+    def metric(name):
+        return "lip2wav_" + name.replace(".", "_")
+
+    lines = []
+    for name, (seconds, n) in sorted(state["timers"].items()):
+        lines.append(f"{metric(name)}_seconds_total {seconds:.6f}")
+        lines.append(f"{metric(name)}_calls_total {n}")
+    for name, value in sorted(state["counters"].items()):
+        lines.append(f"{metric(name)}_total {value}")
+    for name, (last, peak, total, samples) in sorted(state["gauges"].items()):
+        lines.append(f"{metric(name)} {last}")
+        lines.append(f"{metric(name)}_max {peak}")
+        lines.append(f"{metric(name)}_mean {total / max(samples, 1):.3f}")
+    return "\n".join(lines) + "\n"
+
+
+def summary(state, elapsed):
+    rows = [("metric", "total", "calls", "mean", "per second")]
+    for name, (seconds, n) in sorted(state["timers"].items()):
+        rows.append(
+            (name, f"{seconds:.2f}s", str(n), f"{seconds / max(n, 1) * 1000:.2f}ms", "")
+        )
+    for name, value in sorted(state["counters"].items()):
+        if "bytes" in name:
+            total = f"{value / 2 ** 20:.1f}MB"
+            rate = f"{value / 2 ** 20 / elapsed:.2f}MB"
+        else:
+            total, rate = str(value), f"{value / elapsed:.1f}"
+        rows.append((name, total, "", "", rate))
+    for name, (last, peak, total, samples) in sorted(state["gauges"].items()):
+        mean = f"{total / max(samples, 1):.1f}"
+        rows.append((name, f"max {peak}", str(samples), mean, ""))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    lines = [
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+        for row in rows
+    ]
+    lines.insert(1, "-" * len(lines[0]))
+    return f"==> Metrics of {elapsed:.0f}s:\n" + "\n".join(lines)
+
+
+class Reporter:
+    """
+    Writes the cumulative metrics of this process every interval seconds, as
+    appended JSON lines or as a Prometheus text file, and prints a summary
+    table on close. path "-" only prints the summary.
+    """
+
+    def __init__(self, path, interval=10, process="main"):
+        self.path = None if path == "-" else Path(path)
+        self.interval = interval
+        self.process = process
+        self.start = time.time()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        if self.path is None:
+            return
+        state = snapshot()
+        if self.path.suffix == ".prom":
+            path = self.path
+            if self.process != "main":
+                path = path.with_name(f"{path.stem}-{self.process}{path.suffix}")
+            with atomic_path(path) as tmp:
+                tmp.write_text(prometheus(state))
+        else:
+            line = dict(
+                time=time.time(), process=self.process, pid=os.getpid(), **state
+            )
+            with open(self.path, "a") as f:
+                f.write(json.dumps(line) + "\n")
+
+    def close(self, summarize=True):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+        if summarize:
+            print(summary(snapshot(), time.time() - self.start), file=sys.stderr)
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument(
+        "--metrics",
+        help="Record per-stage timers, bytes and queue sizes to this file, as JSON "
+        "lines or Prometheus text (.prom), and print a summary. - for the summary only",
+        nargs="?",
+        const="-",
+        default=None,
+    )
+    parser.add_argument(
+        "--metrics_interval",
+        help="Seconds between two writes of the metrics file",
+        type=float,
+        default=10,
+    )
+
+
+def start(args, process="main"):
+    """Enables the metrics if --metrics is given, returns the reporter to close"""
+    if args.metrics is None:
+        return None
+    enable()
+    return Reporter(args.metrics, args.metrics_interval, process)
@@ -2,107 +2,435 @@ import tqdm
 import cv2
 import argparse
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
 import subprocess
-from operator import itemgetter
+from multiprocessing import Pool
+from collections import namedtuple
 from pathlib import Path
-from itertools import product, count
 
-from .utils import get_filelist
+from . import metrics
+from .archive import FRAME_FORMATS, create_frame_writer
+from .collect import read_detection_df
+from .manifest import Manifest
+from .utils import Lease, atomic_path, lease_path, out_dir
+from .media import IntervalDecoder, decode_audio, probe, read_wav_stream
+from .storage import (
+    SPEC_FORMATS,
+    FeatureCache,
+    audio_hash,
+    config_hash,
+    consolidate,
+    evict,
+    save_specs,
+    specs_match,
+    write_sidecar,
+)
 
 
-def crop(frame, detection):
-    w, h = detection["resolution"]
-    if frame.shape[:2] != (h, w):
-        raise ValueError(f"Expect frame size to be ({h}, {w}), got {frame.shape[:2]}.")
-    y1, y2, x1, x2 = itemgetter("y1", "y2", "x1", "x2")(detection)
-    y1, y2 = map(lambda y: int(y * h), [y1, y2])
-    x1, x2 = map(lambda x: int(x * w), [x1, x2])
-    return frame[y1:y2, x1:x2]
+def crop(frames, boxes, resolution):
+    """
+    frames: iterable of (h w c)
+    boxes: (n 4) integer (y1, y2, x1, x2) in pixels, one per frame
+    """
+    w, h = resolution
+    for frame, (y1, y2, x1, x2) in zip(frames, boxes):
+        if frame.shape[:2] != (h, w):
+            raise ValueError(
+                f"Expect frame size to be ({h}, {w}), got {frame.shape[:2]}."
+            )
+        yield frame[y1:y2, x1:x2]
 
 
-def out_dir(mp4, mkdir=False):
-    path = Path(str(mp4.with_suffix("")).replace("intervals", "preprocessed"))
-    if mkdir:
-        path.mkdir(parents=True, exist_ok=True)
-    return path
+CutDetection = namedtuple("CutDetection", ["frame_ids", "boxes", "resolution"])
 
 
-def prepare_video(mp4, detection):
+class Detections:
+    """
+    Detections kept as contiguous arrays sorted by (youtube_id, cut, frame_id),
+    the rows of a cut are found through an offsets index.
+    """
+
+    def __init__(self, df):
+        df = df.sort_values(["youtube_id", "cut", "frame_id"], kind="stable")
+        w = df["width"].to_numpy(np.int64)
+        h = df["height"].to_numpy(np.int64)
+        self.frame_ids = df["frame_id"].to_numpy(np.int64)
+        # relative to pixels, truncated towards zero like int(y * h)
+        self.boxes = np.stack(
+            [
+                df["y1"].to_numpy() * h,
+                df["y2"].to_numpy() * h,
+                df["x1"].to_numpy() * w,
+                df["x2"].to_numpy() * w,
+            ],
+            axis=1,
+        ).astype(np.int64)
+        self.resolutions = np.stack([w, h], axis=1)
+
+        youtube_ids = df["youtube_id"].to_numpy()
+        cuts = df["cut"].to_numpy()
+        starts = np.ones(len(df), dtype=bool)
+        starts[1:] = (youtube_ids[1:] != youtube_ids[:-1]) | (cuts[1:] != cuts[:-1])
+        starts = np.flatnonzero(starts)
+        ends = np.append(starts[1:], len(df))
+        self.offsets = {
+            (youtube_ids[start], int(cuts[start])): (start, end)
+            for start, end in zip(starts, ends)
+        }
+
+    def __contains__(self, index):
+        return index in self.offsets
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index]
+        return CutDetection(
+            self.frame_ids[start:end],
+            self.boxes[start:end],
+            tuple(self.resolutions[start].tolist()),
+        )
+
+
+def prepare_video(mp4, detection, frame_format="jpg", seek=False):
     if out_dir(mp4).exists():
         # skip crop jpgs if this have been done by detect.py
         return
-    detection = detection.set_index("frame_id").to_dict("index")
+    frame_ids = detection.frame_ids.tolist()
+    frames = (frame for _, frame in read_frames(mp4, frame_ids, seek))
+    metrics.count_file("prepare_video.bytes_read", mp4)
+    # out_dir only appears once all crops are written
+    with atomic_path(out_dir(mp4)) as tmp:
+        tmp.mkdir(parents=True)
+        writer = create_frame_writer(tmp, frame_format)
+        faces = crop(frames, detection.boxes, detection.resolution)
+        faces = metrics.timed("prepare_video.decode", faces)
+        for frame_id, face in zip(frame_ids, faces):
+            with metrics.timer("prepare_video.encode"):
+                writer.write(frame_id, face)
+        writer.close()
+
+
+# seeking is only worth it for gaps longer than a typical GOP
+SEEK_GAP = 250
+SEEK_DENSITY = 0.25
+
+
+def read_frames(mp4, frame_ids, seek=False):
+    """
+    Yields (frame_id, frame) for the sorted frame_ids only. Frames in between
+    are grabbed without being retrieved, and long gaps are seeked over when
+    the detections of this cut are sparse.
+
+    seek: whether the interval was probed as constant fps. OpenCV seeks by
+    timestamp, which only lands on the frame index when the fps is constant.
+    """
+    if not frame_ids:
+        return
+    density = len(frame_ids) / (frame_ids[-1] + 1)
+    seek_gap = SEEK_GAP if seek and density < SEEK_DENSITY else float("inf")
     cap = cv2.VideoCapture(str(mp4))
-    for frame_id in count():
-        running, frame = cap.read()
-        if not running:
-            break
-        if frame_id in detection:
-            face = crop(frame, detection[frame_id])
-            cv2.imwrite(str(out_dir(mp4, mkdir=True) / f"{frame_id}.jpg"), face)
+    try:
+        position = 0
+        for frame_id in frame_ids:
+            if frame_id - position >= seek_gap:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, frame_id)
+                if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) == frame_id:
+                    position = frame_id
+                else:
+                    # inaccurate seek, grab from the start once and never seek again
+                    cap.release()
+                    cap = cv2.VideoCapture(str(mp4))
+                    position = 0
+                    seek_gap = float("inf")
+            for _ in range(frame_id - position):
+                if not cap.grab():
+                    return
+            running, frame = cap.read()
+            if not running:
+                return
+            yield frame_id, frame
+            position = frame_id + 1
+    finally:
+        cap.release()
+
+
+def prepare_fused(mp4, detection, info, args):
+    """
+    Same as prepare_video followed by prepare_audio, but the interval is only demuxed once.
+    Only the audio is decoded when the crops were already written by detect.
+
+    info: the probe of the interval recorded in the manifest, if any. The raw
+    frames are reshaped to the detected resolution, so the actual one is checked
+    beforehand.
+    """
+    if out_dir(mp4).exists():
+        prepare_audio(mp4, args)
+        return
+    if not info or info["width"] <= 0:
+        info = probe(mp4)
+    w, h = detection.resolution
+    size = (info["height"], info["width"])
+    if size != (h, w):
+        raise ValueError(f"Expect frame size to be ({h}, {w}), got {size}.")
+    frame_ids = detection.frame_ids.tolist()
+    wanted = set(frame_ids)
+    decoder = IntervalDecoder(
+        mp4, get_speaker(mp4), args.sample_rate, detection.resolution
+    )
+    try:
+        frames = (frame for i, frame in enumerate(decoder) if i in wanted)
+        metrics.count_file("prepare_fused.bytes_read", mp4)
+        with atomic_path(out_dir(mp4)) as tmp:
+            tmp.mkdir(parents=True)
+            writer = create_frame_writer(tmp, args.frame_format)
+            faces = crop(frames, detection.boxes, detection.resolution)
+            faces = metrics.timed("prepare_fused.decode", faces)
+            for frame_id, face in zip(frame_ids, faces):
+                with metrics.timer("prepare_video.encode"):
+                    writer.write(frame_id, face)
+            writer.close()
+            with metrics.timer("prepare_fused.audio"):
+                audio = decoder.audio()
+    finally:
+        decoder.close()
+    save_audio(mp4, *audio, args)
+
+
+def get_speaker(mp4):
+    # {root}/{speaker}/intervals/{youtube_id}/cut-{i}.mp4
+    return mp4.parts[-4]
 
 
 def prepare_audio(mp4, args):
-    template = "ffmpeg -loglevel panic -y -i {} -ar {} -f wav {}"
-    template2 = "ffmpeg -hide_banner -loglevel panic -threads 1 -y -i {} -async 1 -ac 1 -vn -acodec pcm_s16le -ar 16000 {}"
+    metrics.count_file("prepare_audio.bytes_read", mp4)
+    with metrics.timer("prepare_audio.ffmpeg"):
+        data, sample_rate, pcm = decode_audio(mp4, get_speaker(mp4), args.sample_rate)
+    save_audio(mp4, data, sample_rate, pcm, args)
+
 
+def save_audio(mp4, data, sample_rate, pcm, args):
+    # audio.wav marks the interval as prepared, so it is renamed into place last
     wavpath = out_dir(mp4, mkdir=True) / "audio.wav"
-    speaker = wavpath.parts[-5]
-    if speaker in ["hs", "eh", "dl"]:
-        command = template2.format(mp4, wavpath)
-    else:
-        command = template.format(mp4, args.sample_rate, wavpath)
-    subprocess.call(command, shell=True)
 
     if not args.no_spec:
-        try:
-            load_wav
-        except:
-            from .audio import load_wav, melspectrogram, linearspectrogram
+        save_spectrograms(wavpath.parent, data, sample_rate, pcm, args)
+
+    with metrics.timer("prepare_audio.save_wav"), atomic_path(wavpath) as tmp:
+        tmp.write_bytes(data)
+    metrics.count("prepare_audio.bytes_written", len(data))
+
+
+# the hparams that change the spectrograms
+SPEC_HPARAMS = [
+    "sample_rate",
+    "preemphasize",
+    "preemphasis",
+    "hop_size",
+    "win_size",
+    "n_fft",
+    "fmax",
+    "fmin",
+    "num_mels",
+    "signal_normalization",
+    "min_level_db",
+    "ref_level_db",
+    "max_abs_value",
+    "use_lws",
+    "symmetric_mels",
+    "allow_clipping_in_normalization",
+    "spec_format",
+]
+
+
+def spec_config(args):
+    return {name: getattr(args, name) for name in SPEC_HPARAMS}
+
+
+def spec_digest(args):
+    """The config hash recorded in the manifest for prepared intervals"""
+    return None if args.no_spec else config_hash(spec_config(args))
+
+
+def save_spectrograms(directory, data, sample_rate, pcm, args):
+    """
+    Saves the spectrograms of a cut with a sidecar of their config, taken
+    from the feature cache when this audio was computed with the same config.
+    """
+    from .audio import pcm_to_wav, spectrograms
+
+    config = spec_config(args)
+    digest = audio_hash(data)
+    cache = None
+    if args.feature_cache is not None:
+        cache = FeatureCache(args.feature_cache, config)
+        if cache.get(digest, directory):
+            write_sidecar(directory, config, digest)
+            return
+
+    with metrics.timer("prepare_audio.stft"):
+        wav = pcm_to_wav(pcm, sample_rate, args.sample_rate)
+        [(spec, lspec)] = spectrograms([wav], args)
+    with metrics.timer("prepare_audio.save_specs"):
+        save_specs(directory, spec, lspec, args.spec_format)
+    if cache is not None:
+        cache.put(digest, directory)
+    write_sidecar(directory, config, digest)
 
-        wav = load_wav(wavpath, args.sample_rate)
-        spec = melspectrogram(wav, args)
-        lspec = linearspectrogram(wav, args)
-        np.savez_compressed(wavpath.with_name("mels.npz"), spec=spec, lspec=lspec)
 
+def prepare_spectrograms(mp4, args):
+    """
+    Recomputes the spectrograms of a prepared interval from its audio.wav,
+    without running ffmpeg again.
+    """
+    directory = out_dir(mp4)
+    data = (directory / "audio.wav").read_bytes()
+    _, sample_rate, pcm = read_wav_stream(data)
+    save_spectrograms(directory, data, sample_rate, pcm, args)
 
-def prepare(detection, args):
+
+def list_jobs(detection, manifest, args):
     try:
-        df = pd.read_csv(detection)
+        df = read_detection_df(detection)
     except Exception as e:
         print(str(e) + " Skipped.")
-        return
-    df["resolution"] = df["resolution"].apply(eval)
+        return []
+    detections = Detections(df)
 
-    mp4s = get_filelist(
-        args.root,
-        *detection.stem.split("-"),
-        "intervals/{youtube_id}/**/*.mp4",
-    )
+    speaker, split = detection.stem.split("-")
+    manifest.update(speaker, split)
+    mp4s = manifest.intervals(speaker, split, "prepared", done=False)
+    if not args.no_spec:
+        # only the sidecars of the intervals not recorded with this config are read
+        config, digest = spec_config(args), spec_digest(args)
+        current = []
+        stale = manifest.intervals(speaker, split, "prepared", done=True, config=digest)
+        for mp4 in stale:
+            if specs_match(out_dir(mp4), config):
+                current.append(mp4)
+            else:
+                # prepared with another spectrogram config
+                mp4s.append(mp4)
+        manifest.mark_all(current, "prepared", config=digest)
 
     youtube_ids = set(df["youtube_id"])
 
-    mp4s = list(
-        filter(
-            lambda p: not (out_dir(p) / "audio.wav").exists()
-            and p.parent.name in youtube_ids,
-            mp4s,
-        )
-    )
-
-    grouped = dict(list(df.groupby(["youtube_id", "cut"])))
+    mp4s = [p for p in mp4s if p.parent.name in youtube_ids]
 
+    jobs = []
     for mp4 in mp4s:
         youtube_id = mp4.parts[-2]
         cut = int(mp4.stem.split("-")[-1])
         index = (youtube_id, cut)
-        if index not in grouped:
+        if index not in detections:
             print(f"==> INFO: No face detected in {mp4}, skipped.")
             continue
-        prepare_video(mp4, grouped[index])
-        prepare_audio(mp4, args)
+        jobs.append((mp4, detections[index], manifest.info(mp4), args))
+
+    return jobs
+
+
+def warmup_audio(args):
+    if not args.no_spec:
+        from . import audio
+
+        # built once here so that forked workers inherit the filterbank
+        if args.audio_cache is not None:
+            audio.load_cache(args.audio_cache)
+        audio.warmup_cache(args)
+        if args.audio_cache is not None:
+            audio.save_cache(args.audio_cache)
+
+
+def evict_features(args):
+    if args.feature_cache is not None:
+        removed = evict(args.feature_cache, args.feature_cache_size * 2 ** 30)
+        if removed:
+            print(f"==> Evicted {removed} cached spectrograms.")
+
+
+def prepare(detections, args, pool=None):
+    """
+    pool: forked by the caller after warmup_audio, otherwise a pool of
+    args.workers processes is created here.
+    """
+    manifest = Manifest(args.root)
+    jobs = []
+    for detection in detections:
+        jobs.extend(list_jobs(detection, manifest, args))
+
+    owned = None
+    if pool is None:
+        warmup_audio(args)
+        if args.workers > 1:
+            pool = owned = Pool(args.workers)
+
+    if pool is not None:
+        results = pool.imap_unordered(prepare_pooled, jobs, args.chunksize)
+    else:
+        # recorded into the metrics of this process already
+        results = ((*prepare_interval(job), None) for job in jobs)
+
+    try:
+        for mp4, error, snapshot in tqdm.tqdm(results, total=len(jobs)):
+            metrics.merge(snapshot)
+            if error is not None:
+                print(f"==> ERROR: Failed to prepare {mp4}: {error}")
+            elif (out_dir(mp4) / "audio.wav").exists():
+                manifest.mark(mp4, "prepared", config=spec_digest(args))
+    finally:
+        if owned is not None:
+            owned.close()
+            owned.join()
+
+    if not args.no_spec and args.spec_format == "memmap":
+        for detection in detections:
+            speaker, split = detection.stem.split("-")
+            mp4s = manifest.intervals(speaker, split, "prepared", done=True)
+            print(f"==> Consolidating spectrograms of {speaker}/{split} ...")
+            with metrics.timer("prepare.consolidate"):
+                consolidate(map(out_dir, mp4s), spec_path(args.root, speaker, split))
+    manifest.close()
+    evict_features(args)
+
+
+def spec_path(root, speaker, split):
+    """Prefix of the consolidated spectrograms of a speaker/split"""
+    return Path(root, speaker, f"specs-{split}")
+
+
+def prepare_interval(job):
+    """
+    Prepare a single interval, errors are returned instead of raised so that
+    one broken cut does not stop the whole run.
+    """
+    mp4, detection, info, args = job
+    error = None
+    lease = Lease(lease_path(mp4), args.lease_ttl)
+    # otherwise claimed by another running process
+    if lease.acquire():
+        try:
+            # or finished by another running process meanwhile
+            if not (out_dir(mp4) / "audio.wav").exists():
+                if args.fused:
+                    prepare_fused(mp4, detection, info, args)
+                else:
+                    seek = bool(info and info["constant_fps"])
+                    prepare_video(mp4, detection, args.frame_format, seek)
+                    prepare_audio(mp4, args)
+            elif not args.no_spec and not specs_match(out_dir(mp4), spec_config(args)):
+                prepare_spectrograms(mp4, args)
+        except Exception as e:
+            error = e
+        finally:
+            lease.release()
+    return mp4, error
+
+
+def prepare_pooled(job):
+    """
+    prepare_interval in a pool worker, the metrics it recorded are returned
+    along to be merged by the parent. Only a worker collects, collecting in
+    the parent would reset the counters its reporter is reading.
+    """
+    return (*prepare_interval(job), metrics.collect())
 
 
 def str2bool(s):
@@ -111,13 +439,34 @@ def str2bool(s):
     return s == "true"
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("detections", type=Path, nargs="+")
-    parser.add_argument("--root", type=Path, default="Dataset")
-    parser.add_argument("--sample_rate", type=int, default=16000)
-    # spec
+def add_spec_arguments(parser):
     parser.add_argument("--no-spec", action="store_true")
+    parser.add_argument(
+        "--spec_format",
+        help="npz (compressed), npy (memory-mappable), float16 (npy, half the size), "
+        "or memmap (npy, also merged into one file per speaker/split)",
+        choices=SPEC_FORMATS,
+        default="npz",
+    )
+    parser.add_argument(
+        "--feature_cache",
+        help="Cache spectrograms by audio content and config in this folder, "
+        "to reuse them across runs and configs",
+        type=Path,
+        default=None,
+    )
+    parser.add_argument(
+        "--feature_cache_size",
+        help="Size of the feature cache in GB, least recently used entries are evicted",
+        type=float,
+        default=100,
+    )
+    parser.add_argument(
+        "--audio_cache",
+        help="Persist mel filterbanks and STFT windows to this file across runs",
+        type=Path,
+        default=None,
+    )
     parser.add_argument("--preemphasize", type=str2bool, default=True)
     parser.add_argument("--preemphasis", type=float, default=0.97)
     parser.add_argument("--hop_size", type=float, default=200)
@@ -137,6 +486,45 @@ def main():
         type=str2bool,
         default=True,
     )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("detections", type=Path, nargs="+")
+    parser.add_argument("--root", type=Path, default="Dataset")
+    parser.add_argument("--sample_rate", type=int, default=16000)
+    parser.add_argument(
+        "--workers",
+        help="Number of processes used to prepare intervals in parallel",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--chunksize",
+        help="Number of intervals handed to a worker at a time",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--lease_ttl",
+        help="Seconds after which the claim of a crashed process on an interval expires",
+        type=float,
+        default=3600,
+    )
+    parser.add_argument(
+        "--frame_format",
+        help="Write face crops as one jpg per frame, or one archive per cut",
+        choices=FRAME_FORMATS,
+        default="jpg",
+    )
+    parser.add_argument(
+        "--fused",
+        help="Demux each interval once for frames and audio (frames decoded by ffmpeg), "
+        "intervals whose crops were already written by detect only decode the audio",
+        action="store_true",
+    )
+    add_spec_arguments(parser)
+    metrics.add_metrics_arguments(parser)
     args = parser.parse_args()
 
     print(args)
@@ -153,8 +541,23 @@ def main():
             print("Quiting ...")
             exit()
 
-    for detection in tqdm.tqdm(args.detections):
-        prepare(detection, args)
+    # enabled before the pool is forked so that the workers record too, but
+    # the reporter thread is only started after the fork
+    if args.metrics is not None:
+        metrics.enable()
+    pool = None
+    if args.workers > 1:
+        warmup_audio(args)
+        pool = Pool(args.workers)
+    reporter = metrics.start(args)
+    try:
+        prepare(args.detections, args, pool)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if reporter is not None:
+            reporter.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,302 @@
+import shutil
+import threading
+from multiprocessing import Pool
+from queue import Queue
+from itertools import product
+
+from . import metrics
+from .archive import FRAME_FORMATS
+from .collect import read_detection_csv
+from .cut import STREAMER, cut_video, is_complete
+from .download import DOWNLOADER, attempts, create_datalist, download_one
+from .manifest import Manifest
+from .prepare import (
+    add_spec_arguments,
+    evict_features,
+    prepare_pooled,
+    spec_digest,
+    warmup_audio,
+)
+from .utils import create_parser, out_dir, read_split
+
+
+def done_path(root, speaker, youtube_id):
+    """Marks a video as fully processed by run"""
+    return root / speaker / "preprocessed" / youtube_id / "run.done"
+
+
+class Pipeline:
+    """
+    Streams each video through download, cut, detect and prepare, one thread
+    per stage connected by bounded queues, so that only a few raw videos and
+    intervals are on disk at any time. Raw videos are removed once cut and
+    intervals once prepared, unless they are kept.
+
+    Items are (speaker, split, youtube_id, payload), None ends a stage.
+    """
+
+    def __init__(self, args, ids, pool):
+        self.args = args
+        self.pool = pool
+        self.cut_queue = Queue(args.queue_size)
+        self.detect_queue = Queue(args.queue_size)
+        self.prepare_queue = Queue(args.queue_size)
+        self.stages = [
+            threading.Thread(target=self.download_stage, args=(ids,)),
+            threading.Thread(target=self.cut_stage),
+            threading.Thread(target=self.detect_stage),
+            threading.Thread(target=self.prepare_stage),
+        ]
+        self.prepared = 0
+        self.failed = 0
+        self.lock = threading.Lock()  # failed is counted by every stage
+
+    def run(self):
+        for stage in self.stages:
+            stage.start()
+        for stage in self.stages:
+            stage.join()
+        print(f"==> Finished {self.prepared} videos, {self.failed} failed.")
+
+    def error(self, stage, youtube_id, e):
+        print(f"==> ERROR: Failed to {stage} {youtube_id}: {e}")
+        self.fail()
+
+    def fail(self):
+        with self.lock:
+            self.failed += 1
+
+    def download_stage(self, ids):
+        try:
+            for speaker, split, youtube_id in ids:
+                try:
+                    source = self.download(speaker, youtube_id)
+                except Exception as e:
+                    self.error("download", youtube_id, e)
+                    continue
+                self.cut_queue.put((speaker, split, youtube_id, source))
+        finally:
+            self.cut_queue.put(None)
+
+    def download(self, speaker, youtube_id):
+        """Returns the raw video, None if it is streamed or already cut"""
+        args = self.args
+        video_dir = args.root / speaker / "videos"
+        mp4 = video_dir / f"{youtube_id}.mp4"
+        idir = args.root / speaker / "intervals" / youtube_id
+        if not mp4.exists() and not args.stream and not idir.is_dir():
+            video_dir.mkdir(parents=True, exist_ok=True)
+            mp4, _ = download_one(youtube_id, video_dir, args)
+        return mp4 if mp4.exists() else None
+
+    def cut_stage(self):
+        item = ()
+        manifest = None
+        try:
+            manifest = Manifest(self.args.root)
+            while True:
+                item = self.cut_queue.get()
+                if item is None:
+                    break
+                speaker, split, youtube_id, source = item
+                try:
+                    mp4s = self.cut(manifest, speaker, split, youtube_id, source)
+                except Exception as e:
+                    self.error("cut", youtube_id, e)
+                    continue
+                self.detect_queue.put((speaker, split, youtube_id, mp4s))
+        finally:
+            # unblock the upstream stages if this one stopped early
+            while item is not None:
+                item = self.cut_queue.get()
+            if manifest is not None:
+                manifest.close()
+            self.detect_queue.put(None)
+
+    def cut(self, manifest, speaker, split, youtube_id, source):
+        """Cuts a video into intervals unless this is done, returns the intervals"""
+        args = self.args
+        idir = args.root / speaker / "intervals" / youtube_id
+        duration = float("nan")
+        if source is not None:
+            duration = manifest.probe(source.relative_to(args.root))["duration"]
+        if not is_complete(idir, duration):
+            if source is None and not args.stream:
+                raise RuntimeError("the raw video is missing")
+            _, error = cut_video((youtube_id, source, idir, None, args))
+            if error is not None:
+                raise RuntimeError(error)
+        if source is not None and not args.keep_videos:
+            source.unlink()
+        manifest.update(speaker, split)
+        return sorted(idir.glob("cut-*.mp4"))
+
+    def detect_stage(self):
+        args = self.args
+        item = ()
+        writer = manifest = None
+        try:
+            # imported here so that the pool is forked before torch is loaded
+            from efd import s3fd
+            from .detect import ImageWriter, detect
+
+            model = s3fd(pretrained=True).to(args.device)
+            writer = ImageWriter(args.writers, args.write_queue)
+            manifest = Manifest(args.root)
+            while True:
+                item = self.detect_queue.get()
+                if item is None:
+                    break
+                speaker, split, youtube_id, mp4s = item
+                try:
+                    detect(model, mp4s, args, writer, manifest)
+                except Exception as e:
+                    self.error("detect", youtube_id, e)
+                    continue
+                self.prepare_queue.put(item)
+        finally:
+            # unblock the upstream stages if this one stopped early
+            while item is not None:
+                item = self.detect_queue.get()
+            if writer is not None:
+                writer.close()
+            if manifest is not None:
+                manifest.close()
+            self.prepare_queue.put(None)
+
+    def prepare_stage(self):
+        item = ()
+        manifest = None
+        try:
+            manifest = Manifest(self.args.root)
+            while True:
+                item = self.prepare_queue.get()
+                if item is None:
+                    break
+                speaker, split, youtube_id, mp4s = item
+                try:
+                    self.prepare(manifest, speaker, youtube_id, mp4s)
+                except Exception as e:
+                    self.error("prepare", youtube_id, e)
+        finally:
+            # unblock the upstream stages if this one stopped early
+            while item is not None:
+                item = self.prepare_queue.get()
+            if manifest is not None:
+                manifest.close()
+
+    def prepare(self, manifest, speaker, youtube_id, mp4s):
+        """Prepares the intervals of a video, which is marked as done once all are"""
+        args = self.args
+        jobs = []
+        complete = True
+        for mp4 in mp4s:
+            csv = out_dir(mp4) / "detection.csv"
+            if not csv.exists():
+                complete = False
+                continue
+            df = read_detection_csv(csv)
+            if df is not None and not df.empty:
+                # the crops are already written by detect, only the audio is left
+                jobs.append((mp4, None, None, args))
+        results = self.pool.imap_unordered(prepare_pooled, jobs)
+        for mp4, error, snapshot in results:
+            metrics.merge(snapshot)
+            if error is not None:
+                print(f"==> ERROR: Failed to prepare {mp4}: {error}")
+                complete = False
+            elif (out_dir(mp4) / "audio.wav").exists():
+                manifest.mark(mp4, "prepared", config=spec_digest(args))
+            else:
+                # claimed by another running process
+                complete = False
+        if not complete:
+            self.fail()
+            return
+        if not args.keep_intervals:
+            shutil.rmtree(args.root / speaker / "intervals" / youtube_id)
+        path = done_path(args.root, speaker, youtube_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+        self.prepared += 1
+
+
+def main():
+    parser = create_parser()
+    parser.add_argument(
+        "--queue_size",
+        help="Maximum number of videos waiting between two stages",
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        "--keep_videos",
+        help="Keep the raw videos once cut",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--keep_intervals",
+        help="Keep the intervals once prepared",
+        action="store_true",
+    )
+    # download and cut
+    parser.add_argument("--downloader", default=DOWNLOADER)
+    parser.add_argument("--retries", type=attempts, default=3)
+    parser.add_argument("--backoff", type=float, default=10)
+    parser.add_argument(
+        "--stream",
+        help="Cut straight from a stream instead of downloading the raw videos",
+        action="store_true",
+    )
+    parser.add_argument("--streamer", default=STREAMER)
+    # detect
+    parser.add_argument("--batch_size", default=16, type=int)
+    parser.add_argument("--scale_factor", default=0.5, type=float)
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument("--concurrent_cuts", default=4, type=int)
+    parser.add_argument("--writers", default=4, type=int)
+    parser.add_argument("--write_queue", default=256, type=int)
+    parser.add_argument("--frame_format", choices=FRAME_FORMATS, default="jpg")
+    parser.add_argument("--lease_ttl", default=3600, type=float)
+    parser.add_argument("--checkpoint_interval", default=60, type=float)
+    # prepare
+    parser.add_argument("--sample_rate", type=int, default=16000)
+    parser.add_argument(
+        "--workers",
+        help="Number of processes preparing the intervals of a video",
+        type=int,
+        default=4,
+    )
+    # the crops are always written by detect, only the audio is left to decode
+    parser.set_defaults(fused=False)
+    add_spec_arguments(parser)
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    ids = []
+    for speaker, split in product(args.speakers, args.splits):
+        create_datalist(args.root, speaker, split)
+        for youtube_id in read_split(args.root, speaker, split):
+            if not done_path(args.root, speaker, youtube_id).exists():
+                ids.append((speaker, split, youtube_id))
+    print(f"==> {len(ids)} videos to process.")
+
+    warmup_audio(args)
+    # enabled before the pool is forked so that the workers record too, but
+    # the reporter thread is only started after the fork
+    if args.metrics is not None:
+        metrics.enable()
+    pool = Pool(args.workers)
+    reporter = metrics.start(args)
+    try:
+        Pipeline(args, ids, pool).run()
+    finally:
+        pool.close()
+        pool.join()
+        if reporter is not None:
+            reporter.close()
+    evict_features(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from . import metrics
+from .utils import atomic_path, commit, temp_path
+
+SPEC_FORMATS = ["npz", "npy", "float16", "memmap"]
+
+SPEC_NAMES = ["spec", "lspec"]
+
+# records the config and the audio the spectrograms of a cut were computed from
+SIDECAR = "mels.json"
+
+
+def spec_files(spec_format):
+    if spec_format == "npz":
+        return ["mels.npz"]
+    return [f"mels.{name}.npy" for name in SPEC_NAMES]
+
+
+def save_specs(directory, spec, lspec, spec_format="npz"):
+    """
+    npz: mels.npz, compressed (the original format)
+    npy: mels.spec.npy and mels.lspec.npy, uncompressed and memory-mappable
+    float16: as npy, quantized to float16
+    memmap: as npy, to be merged into a per speaker/split file by consolidate()
+    """
+    directory = Path(directory)
+    remove_specs(directory, keep=spec_format)
+    if spec_format == "npz":
+        with atomic_path(directory / "mels.npz") as tmp:
+            with open(tmp, "wb") as f:
+                np.savez_compressed(f, spec=spec, lspec=lspec)
+            metrics.count_file("spec.bytes_written", tmp)
+        return
+    if spec_format not in SPEC_FORMATS:
+        raise ValueError(f"Unknown spectrogram format {spec_format}.")
+    dtype = np.float16 if spec_format == "float16" else spec.dtype
+    for name, array in zip(SPEC_NAMES, [spec, lspec]):
+        with atomic_path(directory / f"mels.{name}.npy") as tmp:
+            with open(tmp, "wb") as f:
+                np.save(f, array.astype(dtype, copy=False))
+            metrics.count_file("spec.bytes_written", tmp)
+
+
+def remove_specs(directory, keep=None):
+    """Removes the spectrograms of a cut and their sidecar, except the files of keep"""
+    names = set(spec_files("npz") + spec_files("npy") + [SIDECAR])
+    if keep is not None:
+        names -= set(spec_files(keep))
+    for name in names:
+        path = Path(directory) / name
+        if path.exists():
+            path.unlink()
+
+
+def config_hash(config):
+    """A short digest of a dict of hparams"""
+    text = json.dumps(config, sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def audio_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def read_sidecar(directory):
+    try:
+        return json.loads((Path(directory) / SIDECAR).read_text())
+    except FileNotFoundError:
+        return None
+
+
+def write_sidecar(directory, config, digest):
+    sidecar = dict(config=config_hash(config), audio=digest, hparams=config)
+    with atomic_path(Path(directory) / SIDECAR) as tmp:
+        tmp.write_text(json.dumps(sidecar, indent=2, sort_keys=True))
+
+
+def specs_match(directory, config):
+    """
+    Whether the spectrograms of a cut were computed with config. Spectrograms
+    saved before sidecars existed are assumed to match.
+    """
+    sidecar = read_sidecar(directory)
+    if sidecar is None:
+        names = spec_files("npz") + spec_files("npy")
+        return any((Path(directory) / name).exists() for name in names)
+    return sidecar["config"] == config_hash(config)
+
+
+def link(src, dst):
+    """Hard links src to dst, copies if linking is not possible"""
+    with atomic_path(dst) as tmp:
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copyfile(src, tmp)
+
+
+class FeatureCache:
+    """
+    Spectrograms addressed by the hash of the audio they are computed from,
+    in one directory per config ({root}/{config hash}/{audio hash}), so that
+    several configs live side by side and a cut whose audio and config are
+    unchanged is never computed twice. Files are hard linked between the
+    cache and the cuts. Entries are touched when used, evict() removes the
+    least recently used ones beyond a size limit.
+    """
+
+    def __init__(self, root, config):
+        self.config = config
+        self.spec_format = config["spec_format"]
+        self.directory = Path(root) / config_hash(config)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if not (self.directory / "config.json").exists():
+            with atomic_path(self.directory / "config.json") as tmp:
+                tmp.write_text(json.dumps(config, indent=2, sort_keys=True))
+
+    def entry(self, digest):
+        return self.directory / digest[:2] / digest
+
+    def get(self, digest, directory):
+        """Links the cached spectrograms into directory, returns whether found"""
+        entry = self.entry(digest)
+        names = spec_files(self.spec_format)
+        if not all((entry / name).exists() for name in names):
+            metrics.count("feature_cache.misses")
+            return False
+        remove_specs(directory, keep=self.spec_format)
+        for name in names:
+            link(entry / name, Path(directory) / name)
+        os.utime(entry)
+        metrics.count("feature_cache.hits")
+        return True
+
+    def put(self, digest, directory):
+        """Adds the spectrograms just saved to directory"""
+        entry = self.entry(digest)
+        if entry.exists():
+            return
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        tmp = temp_path(entry)
+        tmp.mkdir()
+        try:
+            for name in spec_files(self.spec_format):
+                link(Path(directory) / name, tmp / name)
+            commit(tmp, entry)
+        finally:
+            if tmp.exists():
+                shutil.rmtree(tmp)
+
+
+def evict(root, max_bytes):
+    """
+    Removes the least recently used entries of every config under root until
+    the cache fits in max_bytes. Returns the number of removed entries.
+    """
+    entries = []
+    for path in Path(root).glob("*/??/*"):
+        if path.is_dir() and not path.name.startswith("."):
+            size = sum(f.stat().st_size for f in path.iterdir())
+            entries.append((path.stat().st_mtime, size, path))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        removed += 1
+    return removed
+
+
+def load_specs(directory, mmap=True):
+    """
+    Returns {"spec": ..., "lspec": ...} of a cut whichever format it is saved in, or None.
+    """
+    directory = Path(directory)
+    if (directory / "mels.spec.npy").exists():
+        mmap_mode = "r" if mmap else None
+        return {
+            name: np.load(directory / f"mels.{name}.npy", mmap_mode=mmap_mode)
+            for name in SPEC_NAMES
+        }
+    if (directory / "mels.npz").exists():
+        with np.load(directory / "mels.npz") as f:
+            return {name: f[name] for name in SPEC_NAMES}
+    return None
+
+
+def consolidate(directories, path):
+    """
+    Concatenates the npy spectrograms of many cuts along time into
+    {path}.spec.npy and {path}.lspec.npy, with the (start, end) columns of
+    each cut in {path}.index.csv.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    rows = []
+    found = []
+    shapes = {}
+    start = 0
+    for directory in map(Path, directories):
+        specs = load_specs(directory)
+        if specs is None:
+            continue
+        for name in SPEC_NAMES:
+            shapes[name] = (specs[name].shape[0], specs[name].dtype)
+        length = specs["spec"].shape[1]
+        rows.append(
+            dict(
+                youtube_id=directory.parts[-2],
+                cut=int(directory.name.split("-")[-1]),
+                start=start,
+                end=start + length,
+            )
+        )
+        found.append(directory)
+        start += length
+    if not rows:
+        return
+    for name in SPEC_NAMES:
+        bins, dtype = shapes[name]
+        with atomic_path(path.with_name(f"{path.name}.{name}.npy")) as tmp:
+            out = np.lib.format.open_memmap(tmp, "w+", dtype, (bins, start))
+            for row, directory in zip(rows, found):
+                out[:, row["start"] : row["end"]] = load_specs(directory)[name]
+            out.flush()
+            del out
+    with atomic_path(path.with_name(f"{path.name}.index.csv")) as tmp:
+        pd.DataFrame(rows).to_csv(tmp, index=None)
+
+
+class ConsolidatedSpecs:
+    """
+    Slices the spectrograms of a cut, or a window of it, straight out of the
+    memory-mapped per speaker/split files written by consolidate().
+    """
+
+    def __init__(self, path):
+        path = Path(path)
+        self.arrays = {
+            name: np.load(path.with_name(f"{path.name}.{name}.npy"), mmap_mode="r")
+            for name in SPEC_NAMES
+        }
+        index = pd.read_csv(
+            path.with_name(f"{path.name}.index.csv"), dtype={"youtube_id": str}
+        )
+        self.offsets = {
+            (row.youtube_id, row.cut): (row.start, row.end)
+            for row in index.itertuples()
+        }
+
+    def __getitem__(self, key):
+        """key: (youtube_id, cut) or (youtube_id, cut, begin, end) in spectrogram frames"""
+        youtube_id, cut, *window = key
+        start, end = self.offsets[(youtube_id, cut)]
+        if window:
+            begin, stop = window
+            start, end = start + begin, min(start + stop, end)
+        return {name: array[:, start:end] for name, array in self.arrays.items()}
@@ -1,8 +1,11 @@
 import argparse
 import contextlib
 import os
+import shutil
+import socket
 import threading
-from queue import Queue
+import time
+import uuid
 from pathlib import Path
 
 
@@ -30,10 +33,144 @@ def create_parser(speaker=True, split=True):
     return parser
 
 
-def get_filelist(root, speaker, split, pattern):
+def read_split(root, speaker, split):
     path = (root / speaker / split).with_suffix(".txt")
     with open(path, "r") as f:
-        youtube_ids = f.read().splitlines()
+        return f.read().splitlines()
+
+
+def get_filelist(root, speaker, split, pattern):
+    youtube_ids = read_split(root, speaker, split)
     dirpath = root / speaker
     for youtube_id in youtube_ids:
         yield from dirpath.glob(pattern.format(youtube_id=youtube_id))
+
+
+def out_dir(mp4, mkdir=False):
+    """{root}/{speaker}/preprocessed/{youtube_id}/cut-{i} of an interval"""
+    path = Path(str(mp4.with_suffix("")).replace("intervals", "preprocessed"))
+    if mkdir:
+        path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def lease_path(mp4):
+    """The lock claiming an interval, shared by detect and prepare"""
+    path = out_dir(mp4)
+    return path.with_name(f"{path.name}.lock")
+
+
+class Lease:
+    """
+    An exclusive claim on a piece of work, held as a lock file next to its
+    output, so that concurrent runs (also on other hosts sharing the filesystem)
+    do not duplicate work. A lease not refreshed for ttl seconds is considered
+    abandoned by a crashed run and can be taken over.
+    """
+
+    def __init__(self, path, ttl=600):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.token = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex}"
+        self.refreshed = None
+
+    def acquire(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if self.take_over():
+                return self.acquire()
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(self.token)
+        self.refreshed = time.time()
+        return True
+
+    def take_over(self):
+        """
+        Moves an expired lock aside, returns whether acquiring can be retried.
+        Only the exclusive create in acquire grants the lease, so that two
+        processes taking over the same lock never both hold it.
+        """
+        try:
+            found = self.path.stat()
+        except FileNotFoundError:
+            return True
+        if time.time() - found.st_mtime <= self.ttl:
+            return False
+        # rename is atomic, only one of the competing processes moves the lock away
+        stale = self.path.with_name(f"{self.path.name}.{self.token}")
+        try:
+            os.rename(self.path, stale)
+        except FileNotFoundError:
+            return True
+        moved = stale.stat()
+        if (moved.st_dev, moved.st_ino, moved.st_mtime) != (
+            found.st_dev,
+            found.st_ino,
+            found.st_mtime,
+        ):
+            # a fresh lock was taken in between, put it back unless yet another one was
+            try:
+                os.link(stale, self.path)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+        os.remove(stale)
+        return True
+
+    def owned(self):
+        try:
+            return self.path.read_text() == self.token
+        except FileNotFoundError:
+            return False
+
+    def refresh(self):
+        if time.time() - self.refreshed > self.ttl / 4 and self.owned():
+            os.utime(self.path)
+            self.refreshed = time.time()
+
+    def release(self):
+        if self.owned():
+            os.remove(self.path)
+
+
+def temp_path(path):
+    """A unique sibling of path to write to before renaming it to path"""
+    path = Path(path)
+    token = f"{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}"
+    return path.with_name(f".{path.name}.tmp-{token}")
+
+
+def commit(tmp, path, last=()):
+    """
+    Atomically moves tmp to path, a directory is merged into an existing one.
+    The files named in last are moved after the others, in that order, so that
+    a marker of completeness never lands before the files it covers.
+    """
+    if tmp.is_dir() and path.is_dir():
+        for child in list(tmp.iterdir()):
+            if child.name not in last:
+                os.replace(child, path / child.name)
+        for name in last:
+            if (tmp / name).exists():
+                os.replace(tmp / name, path / name)
+        tmp.rmdir()
+    else:
+        os.replace(tmp, path)
+
+
+@contextlib.contextmanager
+def atomic_path(path):
+    """Yields a temporary path which is renamed to path if no error is raised"""
+    tmp = temp_path(path)
+    try:
+        yield tmp
+        commit(tmp, Path(path))
+    finally:
+        if tmp.is_dir():
+            shutil.rmtree(tmp)
+        elif tmp.exists():
+            tmp.unlink()
@@ -12,7 +12,9 @@ setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     packages=["lip2wav_dataset"],
-    scripts=["lip2wav-dataset"],
+    entry_points={
+        "console_scripts": ["lip2wav-dataset=lip2wav_dataset.cli:main"],
+    },
     install_requires=[
         "efd @ git+https://github.com/enhuiz/efd",
         "tqdm",
@@ -0,0 +1,74 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+from lip2wav_dataset.archive import (
+    FrameArchive,
+    FrameArchiveWriter,
+    JpegDirectory,
+    clear_frames,
+    open_frames,
+)
+
+
+@pytest.fixture
+def images():
+    rng = np.random.default_rng(0)
+    return {
+        frame_id: rng.integers(0, 256, (32 + frame_id, 24, 3), dtype=np.uint8)
+        for frame_id in [0, 1, 2, 5, 8, 13, 21]
+    }
+
+
+def write(writer, images):
+    for frame_id, image in images.items():
+        writer.write(frame_id, image)
+    writer.close()
+
+
+def test_archive_equals_jpg_directory(tmp_path, images):
+    jpg_dir, archive_dir = tmp_path / "jpg", tmp_path / "archive"
+    jpg_dir.mkdir()
+    archive_dir.mkdir()
+    write(JpegDirectory(jpg_dir), images)
+    write(FrameArchiveWriter(archive_dir), images)
+
+    jpgs, archive = open_frames(jpg_dir), open_frames(archive_dir)
+    assert isinstance(archive, FrameArchive)
+    assert list(archive.frame_ids) == list(jpgs.frame_ids) == sorted(images)
+    for frame_id in images:
+        assert archive[frame_id].tobytes() == jpgs[frame_id].tobytes()
+        assert np.array_equal(archive.image(frame_id), jpgs.image(frame_id))
+    assert 3 not in archive
+
+
+def test_archive_resumes_from_flush(tmp_path, images):
+    expected_dir, resumed_dir = tmp_path / "expected", tmp_path / "resumed"
+    expected_dir.mkdir()
+    resumed_dir.mkdir()
+    write(FrameArchiveWriter(expected_dir), images)
+
+    writer = FrameArchiveWriter(resumed_dir)
+    for frame_id, image in images.items():
+        writer.write(frame_id, image)
+        if frame_id == 8:
+            writer.flush()
+    # interrupted after frame 13 was written, but before it was checkpointed
+    writer.file.close()
+    writer = FrameArchiveWriter(resumed_dir, start=13)
+    write(writer, {k: v for k, v in images.items() if k >= 13})
+
+    expected, resumed = FrameArchive(expected_dir), FrameArchive(resumed_dir)
+    assert list(resumed.frame_ids) == list(expected.frame_ids)
+    for frame_id in images:
+        assert resumed[frame_id].tobytes() == expected[frame_id].tobytes()
+    size = (expected_dir / "frames.bin").stat().st_size
+    assert (resumed_dir / "frames.bin").stat().st_size == size
+
+
+def test_clear_frames(tmp_path, images):
+    write(JpegDirectory(tmp_path), images)
+    write(FrameArchiveWriter(tmp_path), images)
+    (tmp_path / "audio.wav").touch()
+    clear_frames(tmp_path)
+    assert [path.name for path in tmp_path.iterdir()] == ["audio.wav"]
@@ -0,0 +1,52 @@
+import argparse
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("librosa")
+wavfile = pytest.importorskip("scipy.io.wavfile")
+prepare = pytest.importorskip("lip2wav_dataset.prepare")
+from lip2wav_dataset import audio
+from lip2wav_dataset.media import read_wav_stream
+
+
+@pytest.fixture
+def hparams():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sample_rate", type=int, default=16000)
+    prepare.add_spec_arguments(parser)
+    return parser.parse_args([])
+
+
+def write_wav(path, channels, sample_rate):
+    t = np.arange(sample_rate) / sample_rate
+    wav = np.stack([np.sin(2 * np.pi * 220 * (c + 1) * t) for c in range(channels)], 1)
+    wavfile.write(path, sample_rate, (wav * 20000).astype(np.int16))
+
+
+@pytest.mark.parametrize("channels", [1, 2])
+def test_pcm_to_wav_equals_load_wav(tmp_path, channels):
+    path = tmp_path / "audio.wav"
+    write_wav(path, channels, 16000)
+    _, sample_rate, pcm = read_wav_stream(path.read_bytes())
+    wav = audio.pcm_to_wav(pcm, sample_rate, 16000)
+    expected = audio.load_wav(path, 16000)
+    assert wav.dtype == expected.dtype
+    assert np.array_equal(wav, expected)
+
+
+def test_pcm_to_wav_resamples_like_load_wav(tmp_path):
+    path = tmp_path / "audio.wav"
+    write_wav(path, 1, 22050)
+    _, sample_rate, pcm = read_wav_stream(path.read_bytes())
+    wav = audio.pcm_to_wav(pcm, sample_rate, 16000)
+    np.testing.assert_allclose(wav, audio.load_wav(path, 16000), atol=1e-6)
+
+
+def test_spectrograms_equal_separate_computation(tmp_path, hparams):
+    path = tmp_path / "audio.wav"
+    write_wav(path, 1, hparams.sample_rate)
+    wav = audio.load_wav(path, hparams.sample_rate)
+    [(spec, lspec)] = audio.spectrograms([wav], hparams)
+    np.testing.assert_allclose(spec, audio.melspectrogram(wav, hparams), atol=1e-5)
+    np.testing.assert_allclose(lspec, audio.linearspectrogram(wav, hparams), atol=1e-5)
@@ -0,0 +1,44 @@
+import sys
+import json
+import subprocess
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+from lip2wav_dataset.cli import COMMANDS
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# only loaded by the code paths that need them
+HEAVY = ["torch", "efd", "tensorflow", "matplotlib", "librosa"]
+
+
+def loaded_modules(code, modules):
+    """Runs code in a fresh interpreter, returns which of modules it has loaded"""
+    code += (
+        "\nimport sys, json\n"
+        f"print(json.dumps([m for m in {modules!r} if m in sys.modules]))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, stdout=subprocess.PIPE, check=True
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def test_help_does_not_import_dependencies():
+    code = (
+        "import sys, runpy\n"
+        "sys.argv = ['lip2wav-dataset', '--help']\n"
+        "runpy.run_module('lip2wav_dataset', run_name='__main__')"
+    )
+    assert loaded_modules(code, ["torch", "cv2", "librosa", "pandas", *HEAVY]) == []
+
+
+@pytest.mark.parametrize("command", list(COMMANDS))
+def test_command_does_not_import_heavy_dependencies(command):
+    for module in ["numpy", "pandas", "cv2", "scipy", "tqdm"]:
+        if importlib.util.find_spec(module) is None:
+            pytest.skip(f"{module} is not installed")
+    code = f"import lip2wav_dataset.{command}"
+    assert loaded_modules(code, HEAVY) == []
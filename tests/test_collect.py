@@ -0,0 +1,29 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("pandas")
+from lip2wav_dataset.collect import read_detection_csv
+
+
+def detection_csv(tmp_path, text):
+    path = tmp_path / "abc" / "cut-1" / "detection.csv"
+    path.parent.mkdir(parents=True)
+    path.write_text(text)
+    return path
+
+
+def test_empty_detection_csv_has_no_detections(tmp_path, capsys):
+    # written by detect for a cut without faces
+    df = read_detection_csv(detection_csv(tmp_path, ""))
+    assert df is not None and df.empty
+    assert {"frame_id", "x1", "youtube_id", "cut"} <= set(df.columns)
+    assert capsys.readouterr().out == ""
+
+
+def test_corrupt_detection_csv_is_skipped(tmp_path, capsys):
+    text = "frame_id,x1,y1,x2,y2\nabc,0.1,0.1,0.2,0.2\n"
+    assert read_detection_csv(detection_csv(tmp_path, text)) is None
+    assert "WARNING" in capsys.readouterr().out
+    df = read_detection_csv(detection_csv(tmp_path / "ok", text.replace("abc", "3")))
+    assert df["frame_id"].tolist() == [3]
+    assert (df["youtube_id"] == "abc").all() and (df["cut"] == 1).all()
@@ -0,0 +1,97 @@
+import argparse
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+pytest.importorskip("pandas")
+from lip2wav_dataset import detect
+from lip2wav_dataset.detect import ImageWriter
+
+
+class Frames:
+    """A frame writer whose writes block until released"""
+
+    def __init__(self, released):
+        self.released = released
+        self.written = []
+
+    def write(self, frame_id, image):
+        self.released.wait()
+        self.written.append(frame_id)
+
+
+def stub_cut(released):
+    return SimpleNamespace(frames=Frames(released), pending=0, error=None)
+
+
+def test_wait_only_for_the_writes_of_a_cut():
+    released = threading.Event()
+    released.set()
+    blocked = threading.Event()
+    writer = ImageWriter(2, 16)
+    slow, fast = stub_cut(blocked), stub_cut(released)
+    try:
+        writer.put(slow, 0, None)
+        for frame_id in range(4):
+            writer.put(fast, frame_id, None)
+        # returns although the other cut still has a write in flight
+        writer.wait(fast)
+        assert fast.frames.written == [0, 1, 2, 3]
+        assert slow.pending == 1
+    finally:
+        blocked.set()
+        writer.join()
+        writer.close()
+    assert slow.pending == 0 and slow.frames.written == [0]
+
+
+class Loader:
+    """A frame loader that claims each cut before yielding its frame"""
+
+    def __init__(self, cuts, *args, **kwargs):
+        self.cuts = cuts
+        self.closed = False
+
+    def __iter__(self):
+        for cut in self.cuts:
+            cut.claimed = cut.lease.acquire()
+            yield None, [(cut, 0)]
+
+    def close(self):
+        self.closed = True
+
+
+def test_failed_detection_releases_the_claimed_cuts(tmp_path, monkeypatch):
+    loaders = []
+
+    def loader(*args, **kwargs):
+        loaders.append(Loader(*args, **kwargs))
+        return loaders[-1]
+
+    monkeypatch.setattr(detect, "VideoFrameLoader", loader)
+    mp4s = [tmp_path / "spk" / "intervals" / "abc" / f"cut-{i}.mp4" for i in range(2)]
+    args = argparse.Namespace(
+        root=tmp_path,
+        scale_factor=1,
+        lease_ttl=60,
+        batch_size=1,
+        device="cpu",
+        concurrent_cuts=1,
+        frame_format="jpg",
+    )
+
+    def fail(images, scale_factor):
+        raise RuntimeError("out of memory")
+
+    writer = ImageWriter(1, 4)
+    try:
+        with pytest.raises(RuntimeError):
+            detect.detect(SimpleNamespace(detect=fail), mp4s, args, writer, None)
+    finally:
+        writer.close()
+    assert loaders[0].closed
+    assert loaders[0].cuts[0].claimed
+    assert not detect.lease_path(mp4s[0]).exists()
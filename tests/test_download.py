@@ -0,0 +1,112 @@
+import sys
+import json
+import shlex
+import argparse
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("tqdm")
+from lip2wav_dataset.download import download, download_one, get_todo_list
+
+# a downloader interrupted half way leaves {output}.mp4.part, a later call resumes it
+RESUMABLE = """
+import os, sys
+output, source, interrupt = sys.argv[1:]
+data = open(source, "rb").read()
+part = output + ".mp4.part"
+done = os.path.getsize(part) if os.path.exists(part) else 0
+with open(part, "ab") as f:
+    f.write(data[done : len(data) // 2] if interrupt == "1" else data[done:])
+if interrupt == "1":
+    sys.exit(1)
+os.rename(part, output + ".mp4")
+"""
+
+
+def make_args(downloader, retries=1, max_failures=0):
+    return argparse.Namespace(
+        downloader=downloader,
+        retries=retries,
+        backoff=0,
+        concurrency=2,
+        max_failures=max_failures,
+    )
+
+
+@pytest.fixture
+def speaker_dir(tmp_path, monkeypatch):
+    """The working directory of download: {root}/{speaker} with a split list"""
+    (tmp_path / "test.txt").write_text("abc\ndef\n")
+    (tmp_path / "videos").mkdir()
+    (tmp_path / "source.mp4").write_bytes(bytes(range(256)) * 64)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def test_download_renames_hidden_output(speaker_dir):
+    source = shlex.quote(str(speaker_dir / "source.mp4"))
+    args = make_args(f"cp {source} {{output}}.mp4")
+    download(get_todo_list("test"), args)
+    videos = speaker_dir / "videos"
+    assert sorted(path.name for path in videos.iterdir()) == ["abc.mp4", "def.mp4"]
+    assert (videos / "abc.mp4").read_bytes() == (speaker_dir / "source.mp4").read_bytes()
+    assert get_todo_list("test") == []
+    assert json.loads((speaker_dir / "download.json").read_text()) == {}
+
+
+def test_download_records_failures(speaker_dir):
+    log = shlex.quote(str(speaker_dir / "calls.log"))
+    failing = make_args(f"sh -c 'echo {{youtube_id}} >> {log}; exit 1'", 2, 2)
+    for _ in range(3):
+        download(["abc"], failing)
+    # two runs of two attempts each, the third run skips the id
+    assert (speaker_dir / "calls.log").read_text().split() == ["abc"] * 4
+    state = json.loads((speaker_dir / "download.json").read_text())
+    assert state["abc"]["failures"] == 2
+    assert "error" in state["abc"]
+    assert sorted(get_todo_list("test")) == ["abc", "def"]
+
+    # a success clears the failures
+    source = shlex.quote(str(speaker_dir / "source.mp4"))
+    download(["abc"], make_args(f"cp {source} {{output}}.mp4"))
+    assert "abc" not in json.loads((speaker_dir / "download.json").read_text())
+
+
+def test_interrupted_download_is_resumed(speaker_dir):
+    script = speaker_dir / "resumable.py"
+    script.write_text(RESUMABLE)
+    source = speaker_dir / "source.mp4"
+    command = f"{shlex.quote(sys.executable)} {shlex.quote(str(script))} {{output}} "
+    command += shlex.quote(str(source))
+    videos = speaker_dir / "videos"
+
+    with pytest.raises(RuntimeError):
+        download_one("abc", videos, make_args(command + " 1"))
+    # the partial file is hidden and not taken as a downloaded video
+    assert not (videos / "abc.mp4").exists()
+    assert [path.name for path in videos.iterdir()] == [".abc.download.mp4.part"]
+    assert "abc" in get_todo_list("test")
+
+    path, size = download_one("abc", videos, make_args(command + " 0"))
+    assert path == videos / "abc.mp4"
+    assert path.read_bytes() == source.read_bytes()
+    assert size == source.stat().st_size
+    assert [p.name for p in videos.iterdir()] == ["abc.mp4"]
+
+
+def test_download_into_path_with_spaces(tmp_path):
+    videos = tmp_path / "data set" / "videos"
+    videos.mkdir(parents=True)
+    source = tmp_path / "source.mp4"
+    source.write_bytes(b"video")
+    path, size = download_one(
+        "abc", videos, make_args(f"cp {shlex.quote(str(source))} {{output}}.mp4")
+    )
+    assert path == videos / "abc.mp4"
+    assert path.read_bytes() == b"video" and size == 5
+
+
+def test_download_without_attempts_is_rejected(speaker_dir):
+    with pytest.raises(ValueError):
+        download_one("abc", speaker_dir / "videos", make_args("true", retries=0))
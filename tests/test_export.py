@@ -0,0 +1,62 @@
+import json
+import argparse
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("scipy")
+pytest.importorskip("pandas")
+from lip2wav_dataset.export import ShardWriter, iter_shards, mel_hparams, to_npy
+from lip2wav_dataset.storage import write_sidecar
+
+
+def samples():
+    rng = np.random.default_rng(0)
+    for i in range(10):
+        frames = [rng.integers(0, 256, 100, dtype=np.uint8) for _ in range(3)]
+        wav = rng.integers(-32768, 32768, 4800, dtype=np.int16)
+        mel = rng.standard_normal((80, 24)).astype(np.float32)
+        meta = dict(youtube_id="abc", cut=i // 4, start_frame=i * 75, fps=25.0)
+        yield f"abc_cut-{i // 4}_{i * 75:05d}", frames, wav, mel, meta
+
+
+def test_shards_round_trip(tmp_path):
+    writer = ShardWriter(str(tmp_path / "dl-test-{:05d}.tar"), 20000)
+    expected = list(samples())
+    for key, frames, wav, mel, meta in expected:
+        members = [(f"{i:03d}.jpg", frame.tobytes()) for i, frame in enumerate(frames)]
+        members.append(("wav.npy", to_npy(wav)))
+        members.append(("mel.npy", to_npy(mel)))
+        members.append(("json", json.dumps(meta).encode()))
+        writer.write(key, members)
+    writer.close()
+
+    # only the renamed shards are left
+    assert len(writer.paths) > 1
+    assert sorted(tmp_path.iterdir()) == writer.paths
+    found = list(iter_shards(writer.paths))
+    assert [sample["key"] for sample in found] == [e[0] for e in expected]
+    for sample, (_, frames, wav, mel, meta) in zip(found, expected):
+        assert [f.tobytes() for f in sample["frames"]] == [f.tobytes() for f in frames]
+        assert np.array_equal(sample["wav"], wav)
+        assert np.array_equal(sample["mel"], mel)
+        assert {k: sample[k] for k in meta} == meta
+
+
+def test_aborted_shard_is_removed(tmp_path):
+    writer = ShardWriter(str(tmp_path / "dl-test-{:05d}.tar"), 2 ** 20)
+    writer.write("abc_cut-0_00000", [("json", b"{}")])
+    writer.abort()
+    assert writer.paths == []
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_mel_hparams_are_read_from_the_sidecar(tmp_path):
+    args = argparse.Namespace(sample_rate=None, hop_size=None)
+    # saved before sidecars existed
+    assert mel_hparams(tmp_path, args) == (16000, 200)
+    write_sidecar(tmp_path, dict(sample_rate=22050, hop_size=256.0), "digest")
+    assert mel_hparams(tmp_path, args) == (22050, 256.0)
+    assert mel_hparams(tmp_path, argparse.Namespace(sample_rate=22050, hop_size=256))
+    with pytest.raises(ValueError):
+        mel_hparams(tmp_path, argparse.Namespace(sample_rate=16000, hop_size=None))
@@ -0,0 +1,57 @@
+import struct
+
+import pytest
+
+np = pytest.importorskip("numpy")
+from lip2wav_dataset.media import read_wav_stream
+
+
+def wav_file(pcm, sample_rate, bits=16, extra=b""):
+    """
+    The bytes of a pcm wav as ffmpeg writes it to a file, with a LIST chunk
+    before the data like the ffmpeg encoder tag.
+    """
+    channels = pcm.shape[1]
+    data = pcm.astype("<i2").tobytes()
+    fmt = struct.pack(
+        "<HHIIHH",
+        1,
+        channels,
+        sample_rate,
+        sample_rate * channels * bits // 8,
+        channels * bits // 8,
+        bits,
+    )
+    chunks = b"fmt " + struct.pack("<I", len(fmt)) + fmt
+    chunks += b"LIST" + struct.pack("<I", len(extra)) + extra + b"\0" * (len(extra) & 1)
+    chunks += b"data" + struct.pack("<I", len(data)) + data
+    return b"RIFF" + struct.pack("<I", 4 + len(chunks)) + b"WAVE" + chunks
+
+
+def as_piped(data):
+    """ffmpeg can not seek back on a pipe, the chunk sizes are left unset"""
+    data = bytearray(data)
+    struct.pack_into("<I", data, 4, 0xFFFFFFFF)
+    offset = data.index(b"data")
+    struct.pack_into("<I", data, offset + 4, 0xFFFFFFFF)
+    return bytes(data)
+
+
+@pytest.mark.parametrize("channels", [1, 2])
+@pytest.mark.parametrize("extra", [b"INFOISFT\x05\0\0\0Lavf\0", b"odd"])
+def test_read_wav_stream_patches_sizes(channels, extra):
+    pcm = np.random.default_rng(0).integers(-32768, 32768, (1601, channels))
+    expected = wav_file(pcm, 16000, extra=extra)
+    data, sample_rate, found = read_wav_stream(as_piped(expected))
+    assert bytes(data) == expected
+    assert sample_rate == 16000
+    assert found.shape == (1601, channels)
+    assert np.array_equal(found, pcm)
+
+
+def test_read_wav_stream_rejects_other_formats():
+    pcm = np.zeros((10, 1), np.int16)
+    with pytest.raises(ValueError):
+        read_wav_stream(b"RIFX" + wav_file(pcm, 16000)[4:])
+    with pytest.raises(ValueError):
+        read_wav_stream(wav_file(pcm, 16000, bits=8))
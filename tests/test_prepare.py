@@ -0,0 +1,234 @@
+import shutil
+import argparse
+from pathlib import Path
+
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+prepare = pytest.importorskip("lip2wav_dataset.prepare")
+
+
+@pytest.fixture(scope="module")
+def mp4(tmp_path_factory):
+    """A 400 frames interval where every frame is different"""
+    path = tmp_path_factory.mktemp("intervals") / "cut-0.mp4"
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"mp4v"), 25, (64, 48))
+    rng = np.random.default_rng(0)
+    for i in range(400):
+        frame = rng.integers(0, 256, (48, 64, 3), dtype=np.uint8)
+        cv2.putText(frame, str(i), (4, 40), cv2.FONT_HERSHEY_SIMPLEX, 1, (255,) * 3)
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+def sequential(mp4):
+    cap = cv2.VideoCapture(str(mp4))
+    frames = []
+    while True:
+        success, frame = cap.read()
+        if not success:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+class InaccurateSeek:
+    """A capture whose seeks land one frame early"""
+
+    opened = 0
+
+    def __init__(self, path, capture=cv2.VideoCapture):
+        self.cap = capture(path)
+        InaccurateSeek.opened += 1
+
+    def set(self, prop, value):
+        return self.cap.set(prop, max(0, value - 1))
+
+    def __getattr__(self, name):
+        return getattr(self.cap, name)
+
+
+class VariableFrameRate(InaccurateSeek):
+    """
+    Seeks by timestamp land on another frame of a variable frame rate video,
+    while the reported position is derived from the same timestamp
+    """
+
+    seeks = 0
+
+    def set(self, prop, value):
+        VariableFrameRate.seeks += 1
+        self.position = value
+        return self.cap.set(prop, value + 7)
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_POS_FRAMES and hasattr(self, "position"):
+            return self.position
+        return self.cap.get(prop)
+
+
+@pytest.mark.parametrize(
+    "frame_ids", [[0, 1, 2, 3], [5, 300, 301, 399], list(range(0, 400, 3))]
+)
+@pytest.mark.parametrize("seek", [False, True])
+def test_read_frames_equals_sequential_read(mp4, frame_ids, seek):
+    frames = sequential(mp4)
+    found = list(prepare.read_frames(mp4, frame_ids, seek))
+    assert [frame_id for frame_id, _ in found] == frame_ids
+    for frame_id, frame in found:
+        assert frame.tobytes() == frames[frame_id].tobytes()
+
+
+def test_read_frames_inaccurate_seek_reopens_once(mp4, monkeypatch):
+    frames = sequential(mp4)
+    monkeypatch.setattr(prepare, "SEEK_GAP", 50)
+    monkeypatch.setattr(InaccurateSeek, "opened", 0)
+    monkeypatch.setattr(prepare.cv2, "VideoCapture", InaccurateSeek)
+    frame_ids = [0, 100, 200, 300, 399]
+    found = list(prepare.read_frames(mp4, frame_ids, seek=True))
+    assert InaccurateSeek.opened == 2
+    assert [frame_id for frame_id, _ in found] == frame_ids
+    for frame_id, frame in found:
+        assert frame.tobytes() == frames[frame_id].tobytes()
+
+
+def test_read_frames_variable_frame_rate_does_not_seek(mp4, monkeypatch):
+    frames = sequential(mp4)
+    monkeypatch.setattr(prepare, "SEEK_GAP", 50)
+    monkeypatch.setattr(VariableFrameRate, "seeks", 0)
+    monkeypatch.setattr(prepare.cv2, "VideoCapture", VariableFrameRate)
+    frame_ids = [0, 100, 200, 300, 399]
+    # not probed as constant fps, the position check would not catch the wrong frame
+    found = list(prepare.read_frames(mp4, frame_ids, seek=False))
+    assert VariableFrameRate.seeks == 0
+    assert [frame_id for frame_id, _ in found] == frame_ids
+    for frame_id, frame in found:
+        assert frame.tobytes() == frames[frame_id].tobytes()
+
+
+def detection_df(rng):
+    """Detections of several cuts, shuffled like the rows of a merged csv"""
+    pd = pytest.importorskip("pandas")
+    rows = []
+    for youtube_id, cut, width, height in [
+        ("a", 0, 64, 48),
+        ("a", 2, 64, 48),
+        ("b", 0, 32, 24),
+        ("b", 1, 32, 24),
+    ]:
+        for frame_id in sorted(rng.choice(400, 30, replace=False)):
+            y1, y2 = sorted(rng.uniform(0, 1, 2))
+            x1, x2 = sorted(rng.uniform(0, 1, 2))
+            rows.append(
+                dict(
+                    youtube_id=youtube_id,
+                    cut=cut,
+                    frame_id=frame_id,
+                    x1=round(x1, 4),
+                    y1=round(y1, 4),
+                    x2=round(x2, 4),
+                    y2=round(y2, 4),
+                    width=width,
+                    height=height,
+                )
+            )
+    return pd.DataFrame(rows).sample(frac=1, random_state=0)
+
+
+def legacy_crop(frame, detection):
+    """The crop of a frame before detections were kept as arrays"""
+    w, h = detection["resolution"]
+    y1, y2 = int(detection["y1"] * h), int(detection["y2"] * h)
+    x1, x2 = int(detection["x1"] * w), int(detection["x2"] * w)
+    return frame[y1:y2, x1:x2]
+
+
+def test_detections_equal_grouped_rows():
+    rng = np.random.default_rng(0)
+    df = detection_df(rng)
+    detections = prepare.Detections(df)
+    groups = dict(list(df.groupby(["youtube_id", "cut"])))
+    assert set(detections.offsets) == set(groups)
+    assert ("a", 1) not in detections
+    for index, group in groups.items():
+        group = group.sort_values("frame_id")
+        detection = detections[index]
+        assert detection.frame_ids.tolist() == group["frame_id"].tolist()
+        width, height = map(int, group.iloc[0][["width", "height"]])
+        assert detection.resolution == (width, height)
+
+        frames = [
+            rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+            for _ in range(len(group))
+        ]
+        faces = prepare.crop(frames, detection.boxes, detection.resolution)
+        for frame, face, row in zip(frames, faces, group.to_dict("records")):
+            row["resolution"] = (width, height)
+            assert np.array_equal(face, legacy_crop(frame, row))
+
+
+def prepare_args(root, workers):
+    return argparse.Namespace(
+        root=root,
+        workers=workers,
+        chunksize=1,
+        lease_ttl=60,
+        fused=False,
+        frame_format="jpg",
+        no_spec=True,
+        spec_format="npz",
+        feature_cache=None,
+        audio_cache=None,
+    )
+
+
+def stub_audio(mp4, args):
+    """Stands in for ffmpeg, the wav only depends on the interval"""
+    prepare.save_audio(mp4, mp4.read_bytes()[-64:], 16000, None, args)
+
+
+def tree(root):
+    return {
+        str(path.relative_to(root)): path.read_bytes()
+        for path in sorted((root / "dl" / "preprocessed").rglob("*"))
+        if path.is_file()
+    }
+
+
+def test_prepare_workers_equal_serial(mp4, tmp_path, monkeypatch):
+    monkeypatch.setattr(prepare, "prepare_audio", stub_audio)
+    outputs = []
+    for workers in [1, 2]:
+        rng = np.random.default_rng(0)
+        root = tmp_path / str(workers)
+        jobs = []
+        for cut in range(4):
+            path = root / "dl" / "intervals" / "abc" / f"cut-{cut}.mp4"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy(mp4, path)
+            frame_ids = np.sort(rng.choice(400, 20, replace=False))
+            boxes = np.tile([4, 40, 8, 56], (20, 1))
+            detection = prepare.CutDetection(frame_ids, boxes, (64, 48))
+            jobs.append((path, detection, None, prepare_args(root, workers)))
+        # the same list is handed to both runs, workers only changes the pool
+        monkeypatch.setattr(prepare, "list_jobs", lambda *_, jobs=jobs: jobs)
+        prepare.prepare([Path("dl-test.csv")], prepare_args(root, workers))
+        outputs.append(tree(root))
+    assert len(outputs[0]) == 4 * 21
+    assert outputs[0] == outputs[1]
+
+
+def test_fused_checks_the_frame_size_before_decoding(mp4, monkeypatch):
+    def decoder(*args):
+        raise AssertionError("decoded with the wrong frame size")
+
+    monkeypatch.setattr(prepare, "IntervalDecoder", decoder)
+    detection = prepare.CutDetection(
+        np.arange(3), np.tile([4, 40, 8, 56], (3, 1)), (32, 24)
+    )
+    info = dict(width=64, height=48, constant_fps=True)
+    with pytest.raises(ValueError, match="frame size"):
+        prepare.prepare_fused(mp4, detection, info, prepare_args(mp4.parent, 1))
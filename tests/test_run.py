@@ -0,0 +1,76 @@
+import sys
+import types
+import argparse
+import threading
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+pytest.importorskip("pandas")
+from lip2wav_dataset import detect, run
+
+IDS = ["abc", "def", "ghi", "jkl"]
+
+
+def pipeline_args(root):
+    return argparse.Namespace(
+        root=root,
+        queue_size=1,
+        stream=False,
+        keep_videos=True,
+        keep_intervals=True,
+        device="cpu",
+        writers=1,
+        write_queue=4,
+    )
+
+
+@pytest.fixture
+def root(tmp_path, monkeypatch):
+    """Raw videos already downloaded, and a stand-in detector"""
+    (tmp_path / "dl").mkdir()
+    (tmp_path / "dl" / "test.txt").write_text("\n".join(IDS) + "\n")
+    (tmp_path / "dl" / "videos").mkdir()
+    for youtube_id in IDS:
+        (tmp_path / "dl" / "videos" / f"{youtube_id}.mp4").touch()
+    s3fd = lambda pretrained: types.SimpleNamespace(to=lambda device: None)
+    monkeypatch.setitem(sys.modules, "efd", types.SimpleNamespace(s3fd=s3fd))
+    monkeypatch.setattr(detect, "detect", lambda *args: None)
+    return tmp_path
+
+
+def fail(*args):
+    raise FileNotFoundError("ffprobe")
+
+
+def run_pipeline(root):
+    pipeline = run.Pipeline(pipeline_args(root), [("dl", "test", i) for i in IDS], None)
+    thread = threading.Thread(target=pipeline.run, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    assert not thread.is_alive(), "the pipeline is stuck"
+    return pipeline
+
+
+def test_failed_probes_do_not_block_the_pipeline(root, monkeypatch):
+    monkeypatch.setattr(run.Manifest, "probe", fail)
+    pipeline = run_pipeline(root)
+    assert pipeline.failed == len(IDS)
+    assert pipeline.prepared == 0
+
+
+def test_failed_cuts_do_not_block_the_pipeline(root, monkeypatch):
+    monkeypatch.setattr(run.Manifest, "probe", lambda self, path: dict(duration=60.0))
+    monkeypatch.setattr(run, "cut_video", fail)
+    pipeline = run_pipeline(root)
+    assert pipeline.failed == len(IDS)
+    assert pipeline.prepared == 0
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_failed_stage_setup_does_not_block_the_pipeline(root, monkeypatch):
+    # e.g. the manifest of the cut stage can not be opened
+    monkeypatch.setattr(run, "Manifest", fail)
+    pipeline = run_pipeline(root)
+    assert pipeline.prepared == 0
@@ -0,0 +1,26 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("pandas")
+from lip2wav_dataset.storage import ConsolidatedSpecs, consolidate, save_specs
+
+
+def test_consolidated_numeric_youtube_ids(tmp_path):
+    rng = np.random.default_rng(0)
+    expected = {}
+    directories = []
+    for youtube_id in ["00123", "4567"]:
+        directory = tmp_path / "preprocessed" / youtube_id / "cut-0"
+        directory.mkdir(parents=True)
+        spec = rng.standard_normal((80, 30)).astype(np.float32)
+        lspec = rng.standard_normal((401, 30)).astype(np.float32)
+        save_specs(directory, spec, lspec, "npy")
+        expected[youtube_id] = spec
+        directories.append(directory)
+    consolidate(directories, tmp_path / "specs-test")
+
+    specs = ConsolidatedSpecs(tmp_path / "specs-test")
+    for youtube_id, spec in expected.items():
+        # zero-padded and numeric-looking ids are kept as strings
+        assert np.array_equal(specs[(youtube_id, 0)]["spec"], spec)
+        assert np.array_equal(specs[(youtube_id, 0, 5, 10)]["spec"], spec[:, 5:10])
@@ -0,0 +1,69 @@
+import os
+import multiprocessing
+import time
+
+from lip2wav_dataset.utils import Lease
+
+
+def test_lease_is_exclusive(tmp_path):
+    first, second = Lease(tmp_path / "cut-0.lock"), Lease(tmp_path / "cut-0.lock")
+    assert first.acquire()
+    assert not second.acquire()
+    first.release()
+    assert second.acquire()
+    assert second.owned() and not first.owned()
+
+
+def test_expired_lease_is_taken_over_once(tmp_path):
+    path = tmp_path / "cut-0.lock"
+    crashed = Lease(path, ttl=60)
+    assert crashed.acquire()
+    stale = time.time() - 120
+    os.utime(path, (stale, stale))
+
+    leases = [Lease(path, ttl=60) for _ in range(3)]
+    assert [lease.acquire() for lease in leases] == [True, False, False]
+    assert leases[0].owned() and not crashed.owned()
+    # the lease of the crashed run does not remove the new one
+    crashed.release()
+    assert leases[0].owned()
+    # no token file is left behind
+    assert [p.name for p in tmp_path.iterdir()] == ["cut-0.lock"]
+
+
+
+def delayed(move, delay):
+    def wrapper(*args):
+        time.sleep(delay)
+        return move(*args)
+
+    return wrapper
+
+
+def take_over(path, index, barrier, results):
+    # every process has seen the stale lock before the others move it, in turn
+    os.rename = delayed(os.rename, 0.1 * index)
+    os.replace = delayed(os.replace, 0.1 * index)
+    lease = Lease(path, ttl=60)
+    barrier.wait()
+    results.put(lease.acquire())
+
+
+def test_concurrent_take_overs_have_one_owner(tmp_path):
+    context = multiprocessing.get_context("fork")
+    path = tmp_path / "cut-0.lock"
+    path.write_text("crashed")
+    stale = time.time() - 120
+    os.utime(path, (stale, stale))
+    barrier, results = context.Barrier(3), context.Queue()
+    processes = [
+        context.Process(target=take_over, args=(path, i, barrier, results))
+        for i in range(3)
+    ]
+    for process in processes:
+        process.start()
+    acquired = [results.get(timeout=30) for _ in processes]
+    for process in processes:
+        process.join()
+    assert acquired.count(True) == 1
+    assert [p.name for p in tmp_path.iterdir()] == ["cut-0.lock"]